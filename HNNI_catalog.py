@@ -0,0 +1,255 @@
+import numpy as np
+import json
+import os
+import struct
+
+####################################################################################################
+###################################### Array-backed HNNI catalog ###################################
+####################################################################################################
+
+class CatalogIndex:
+
+    """
+
+    Compact, array-backed version of the catalog_data dictionary (ZAMS mass -> data frame) used by HNNI.
+
+    Args:
+        masses: ZAMS masses of the tracks, in ascending order.
+        columns: names of the stored columns, the first of which is 's'.
+        offsets: row offsets of the tracks in data (track i occupies the rows offsets[i]:offsets[i+1]).
+        data: float64 block of shape (len(columns), offsets[-1]), each track's column values being contiguous.
+
+    Usage:
+        >> catalog_index = CatalogIndex.from_catalog(catalog_data, ['s', 'log_L', 'log_Teff'])
+        >> catalog_index.save('data/catalog_index')
+        >> catalog_index = CatalogIndex.load('data/catalog_index', mmap_mode='r')
+
+    The index is picklable, and when loaded with mmap_mode='r' its data block is shared between processes
+    through the page cache.
+
+    """
+
+    def __init__(self, masses, columns, offsets, data):
+        self.masses = np.asarray(masses, dtype = 'float64')
+        self.log_masses = np.log10(self.masses)
+        self.columns = list(columns)
+        self.offsets = np.asarray(offsets, dtype = 'int64')
+        self.data = data
+        # (filename, grid key) of the CatalogStore the index is a view of, if any
+        self.source = None
+        # incremented by update(), so that cached HNNI brackets of the former tracks are not reused
+        self.version = 0
+        if self.columns[0] != 's':
+            raise ValueError("the first catalog column must be 's'")
+        if np.any(np.diff(self.masses) <= 0):
+            raise ValueError('the catalog masses must be unique and in ascending order')
+
+    @classmethod
+    def from_catalog(cls, catalog, columns = None):
+        masses = sorted(catalog.keys())
+        if columns is None:
+            # all numerical columns of the catalog tracks
+            columns = list(catalog[masses[0]].select_dtypes(include = 'number').columns)
+        columns = ['s'] + [column for column in columns if column != 's']
+        lengths = [len(catalog[mass]) for mass in masses]
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        data = np.empty((len(columns), offsets[-1]), dtype = 'float64')
+        for i, mass in enumerate(masses):
+            data[:, offsets[i]:offsets[i+1]] = catalog[mass][columns].to_numpy(dtype = 'float64').T
+        return cls(masses, columns, offsets, data)
+
+    def __len__(self):
+        return len(self.masses)
+
+    # an index backed by a CatalogStore is pickled as a reference to the store file, so that worker processes 
+    # map the same pages instead of receiving a copy of the data block
+    def __reduce__(self):
+        if self.source is not None:
+            return (_store_grid, self.source)
+        return (CatalogIndex, (self.masses, self.columns, self.offsets, self.data))
+
+    # positions of the given column names in the data block
+    def column_indices(self, columns):
+        missing = [column for column in columns if column not in self.columns]
+        if missing:
+            raise KeyError('columns not in catalog index: ' + ', '.join(missing))
+        return [self.columns.index(column) for column in columns]
+
+    # s values (a view) of the track with index track_id
+    def track_s(self, track_id):
+        return self.data[0, self.offsets[track_id]:self.offsets[track_id+1]]
+
+    # s values (a view) and (n_points, n_columns) values of the given column indices, of the track with index track_id
+    def track_arrays(self, track_id, column_indices):
+        start, stop = self.offsets[track_id], self.offsets[track_id+1]
+        return self.data[0, start:stop], self.data[column_indices, start:stop].T
+
+    # adds the given tracks (a dictionary of ZAMS masses and data frames, as catalog_data) to the index in place,
+    # replacing the tracks of the same masses; the data block is rebuilt in memory (detached from a CatalogStore file)
+    def update(self, tracks):
+        if not tracks:
+            return self
+        new_masses = np.array(sorted(tracks.keys()), dtype = 'float64')
+        keep = ~np.isin(self.masses, new_masses)
+        masses = np.concatenate([self.masses[keep], new_masses])
+        blocks = [self.data[:, self.offsets[i]:self.offsets[i+1]] for i in np.flatnonzero(keep)]
+        blocks += [tracks[mass][self.columns].to_numpy(dtype = 'float64').T for mass in sorted(tracks.keys())]
+        order = np.argsort(masses, kind = 'stable')
+        lengths = np.array([blocks[i].shape[1] for i in order], dtype = 'int64')
+        self.masses = masses[order]
+        self.log_masses = np.log10(self.masses)
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)])
+        self.data = np.concatenate([blocks[i] for i in order], axis = 1) if len(order) > 0 else np.empty((len(self.columns), 0))
+        self.source = None
+        self.version += 1
+        return self
+
+    # index of the catalog without the tracks of the given masses (e.g. for leave-one-out tests), with a copy of the data
+    def without(self, masses):
+        keep = ~np.isin(self.masses, np.ravel(masses))
+        lengths = np.diff(self.offsets)[keep]
+        rows = np.concatenate([np.arange(self.offsets[i], self.offsets[i+1]) for i in np.flatnonzero(keep)] or [np.zeros(0, dtype = 'int64')])
+        return CatalogIndex(self.masses[keep], self.columns, np.concatenate([[0], np.cumsum(lengths)]), self.data[:, rows])
+
+    # data frame of a single track, as in catalog_data
+    def track(self, mass):
+        import pandas as pd
+        track_id = int(np.searchsorted(self.masses, mass))
+        if track_id == len(self.masses) or self.masses[track_id] != mass:
+            raise KeyError(mass)
+        start, stop = self.offsets[track_id], self.offsets[track_id+1]
+        return pd.DataFrame(self.data[:, start:stop].T, columns = self.columns)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok = True)
+        np.save(os.path.join(path, 'data.npy'), np.ascontiguousarray(self.data))
+        np.save(os.path.join(path, 'offsets.npy'), self.offsets)
+        np.save(os.path.join(path, 'masses.npy'), self.masses)
+        with open(os.path.join(path, 'columns.json'), 'w') as f:
+            json.dump(self.columns, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode = None):
+        with open(os.path.join(path, 'columns.json')) as f:
+            columns = json.load(f)
+        return cls(np.load(os.path.join(path, 'masses.npy')), columns, np.load(os.path.join(path, 'offsets.npy')),
+                   np.load(os.path.join(path, 'data.npy'), mmap_mode = mmap_mode))
+
+####################################################################################################
+###################################### Multi-grid catalog store ####################################
+####################################################################################################
+
+store_magic = b'HNNICAT1'
+store_alignment = 64
+
+def _aligned(n_bytes):
+    return -(-n_bytes // store_alignment)*store_alignment
+
+class CatalogStore:
+
+    """
+
+    Single-file, memory-mapped catalog of several stellar evolution grids (e.g. MIST grids of different [Fe/H] and
+    v/vcrit), each stored as the data block of a CatalogIndex. The file holds a JSON header with the track index of
+    every grid (grid key, columns, ZAMS masses, row offsets, position of the data block), followed by the 64-byte 
+    aligned float64 data blocks.
+
+    Args:
+        filename: path of a store written with CatalogStore.write().
+
+    Usage:
+        >> CatalogStore.write('data/MIST_grids.cat', {(0.0, 0.0): catalog_data, (-0.5, 0.4): catalog_data2})
+        >> store = CatalogStore('data/MIST_grids.cat')
+        >> store.keys()
+        >> values = HNNI_batch(store[(0.0, 0.0)], test_masses, test_s, ['log_L', 'log_Teff'])
+
+    Opening a store only reads the header; the grids are CatalogIndex objects whose data blocks are zero-copy views
+    of the file mapping, read on demand and shared through the page cache by all processes that open the store.
+    Pickled grids are reopened from the file in the receiving process.
+
+    """
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        with open(self.filename, 'rb') as f:
+            magic, header_size = struct.unpack('<8sQ', f.read(16))
+            if magic != store_magic:
+                raise ValueError(filename + ' is not a catalog store')
+            header = json.loads(f.read(header_size).decode())
+        self._mapping = np.memmap(self.filename, dtype = 'uint8', mode = 'r')
+        self._header = {tuple(grid['key']): grid for grid in header['grids']}
+        self._grids = {}
+
+    def keys(self):
+        return list(self._header.keys())
+
+    def __len__(self):
+        return len(self._header)
+
+    def __contains__(self, key):
+        return tuple(np.ravel(key).tolist()) in self._header
+
+    # CatalogIndex of the grid with the given key (the same object on repeated calls)
+    def __getitem__(self, key):
+        key = tuple(np.ravel(key).tolist())
+        if key not in self._grids:
+            if key not in self._header:
+                raise KeyError(key)
+            grid = self._header[key]
+            n_bytes = 8*grid['shape'][0]*grid['shape'][1]
+            data = self._mapping[grid['data_offset']:grid['data_offset'] + n_bytes].view('float64').reshape(grid['shape'])
+            catalog_index = CatalogIndex(grid['masses'], grid['columns'], grid['offsets'], data)
+            catalog_index.source = (self.filename, key)
+            self._grids[key] = catalog_index
+        return self._grids[key]
+
+    def __reduce__(self):
+        return (_open_store, (self.filename,))
+
+    # writes the grids, a dictionary of grid keys (tuples of numbers, e.g. ([Fe/H], v/vcrit)) and catalogs given as 
+    # catalog_data dictionaries (the output of MIST_data_reader) or as CatalogIndex objects, to a store file;
+    # columns selects the stored columns of catalog_data dictionaries (all numerical columns by default)
+    @staticmethod
+    def write(filename, grids, columns = None):
+        def as_index(catalog):
+            return catalog if isinstance(catalog, CatalogIndex) else CatalogIndex.from_catalog(catalog, columns)
+        
+        # track index of all grids (each grid is converted once here, and again when its data block is written, 
+        # so that only one grid at a time is held in memory)
+        entries = []
+        for key, catalog in grids.items():
+            catalog_index = as_index(catalog)
+            entries.append({'key': list(np.ravel(key).tolist()), 'columns': catalog_index.columns, 'masses': catalog_index.masses.tolist(),
+                            'offsets': catalog_index.offsets.tolist(), 'shape': [len(catalog_index.columns), int(catalog_index.offsets[-1])]})
+        
+        # data block positions, after the header (whose size depends on them, hence the fixed-point iteration)
+        data_start = 0
+        while True:
+            position = data_start
+            for entry in entries:
+                entry['data_offset'] = position
+                position = _aligned(position + 8*entry['shape'][0]*entry['shape'][1])
+            header = json.dumps({'version': 1, 'grids': entries}).encode()
+            if _aligned(16 + len(header)) == data_start:
+                break
+            data_start = _aligned(16 + len(header))
+        
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(struct.pack('<8sQ', store_magic, len(header)))
+            f.write(header)
+            for entry, catalog in zip(entries, grids.values()):
+                f.write(b'\0'*(entry['data_offset'] - f.tell()))
+                f.write(np.ascontiguousarray(as_index(catalog).data, dtype = '<f8').tobytes())
+        os.replace(filename + '.tmp', filename)
+        return CatalogStore(filename)
+
+# stores opened in this process, by file name
+_open_stores = {}
+
+def _open_store(filename):
+    if filename not in _open_stores:
+        _open_stores[filename] = CatalogStore(filename)
+    return _open_stores[filename]
+
+def _store_grid(filename, key):
+    return _open_store(filename)[key]
@@ -2,6 +2,12 @@ import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
 import sys
+import hashlib
+import threading
+import weakref
+import itertools
+import bisect
+from collections import OrderedDict
 
 ####################################################################################################
 ############################################### Paths ##############################################
@@ -14,6 +20,8 @@ test_path =  data_path # hold-out stellar tracks for testing the accuracy of HNN
 
 import eep_read1
 from processing_and_plot_routines import *
+from HNNI_catalog import *
+from pipeline_stats import stage_stats, profile_stages
 
 ####################################################################################################
 ############################################ ZAMS masses & test data ###############################
@@ -79,63 +87,381 @@ def neighbor_points(values, test):
         lower = np.amin(values)
     return lower, upper
 
-def HNNI_general(catalog, test_mass, test_s, target):
-    all_masses = sorted(catalog.keys())
-    
-    # upper and lower ZAMS mass grid points
-    m_min, m_max = neighbor_points(np.array(all_masses), test_mass)
-    
-    # s values at mmin and mmax
-    if not m_min == m_max:
-        smin_values, smax_values = catalog[m_min]["s"], catalog[m_max]["s"]
-    
-        # target variable values at mmin and mmax
-        target_min_values, target_max_values = catalog[m_min][target], catalog[m_max][target]
+####################################################################################################
+######################################### Batched HNNI #############################################
+####################################################################################################
+
+# lower and upper nearest neighbors of each test value in an ascending array of grid values, as indices;
+# outside of the grid range, both are clamped to the first (or last) grid point, as in neighbor_points
+def neighbor_indices(sorted_values, test_values):
+    upper = np.searchsorted(sorted_values, test_values, side = 'left')
+    lower = np.searchsorted(sorted_values, test_values, side = 'right') - 1
+    upper = np.minimum(upper, len(sorted_values)-1)
+    lower = np.maximum(lower, 0)
+    return lower, upper
+
+# weight of the upper neighbor in the linear interpolation between the lower and upper neighbor values
+# (zero where both neighbors coincide)
+def linear_weights(x_lower, x_upper, x):
+    dx = x_upper - x_lower
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.where(dx != 0, (x - x_lower)/np.where(dx != 0, dx, 1.), 0.)
+
+# s brackets on the catalog tracks: for each (track id, test s) query, the indices of the lower and upper s neighbors 
+# within the track and the weight of the upper one, with track_s(track_id) returning the track's ascending s values
+def s_brackets(track_s, track_ids, test_s):
+    index_min, index_max = np.empty(len(track_ids), dtype = 'int64'), np.empty(len(track_ids), dtype = 'int64')
+    weight = np.empty(len(track_ids))
+    # queries grouped by track, so that each track is looked up once
+    order = np.argsort(track_ids, kind = 'stable')
+    unique_ids, starts = np.unique(track_ids[order], return_index = True)
+    for track_id, query_rows in zip(unique_ids, np.split(order, starts[1:])):
+        s_values = track_s(track_id)
+        s_query = test_s[query_rows]
+        index_min[query_rows], index_max[query_rows] = neighbor_indices(s_values, s_query)
+        weight[query_rows] = linear_weights(s_values[index_min[query_rows]], s_values[index_max[query_rows]], s_query)
+    return index_min, index_max, weight
+
+class HNNIBrackets:
+
+    """
+
+    Mass and s brackets of a set of (test_mass, test_s) queries on a catalog, which do not depend on the target variables.
+
+    Attributes:
+        lower, upper    Indices of the lower and upper ZAMS mass neighbor tracks of each query.
+        mass_weight     Weight of the upper mass neighbor of each query.
+        track_ids       Lower neighbor tracks followed by the upper neighbor tracks (2 x number of queries).
+        index_min       Index of the lower s neighbor within the track, for each entry of track_ids.
+        index_max       Index of the upper s neighbor within the track, for each entry of track_ids.
+        s_weight        Weight of the upper s neighbor, for each entry of track_ids.
+
+    """
+
+    __slots__ = ('lower', 'upper', 'mass_weight', 'track_ids', 'index_min', 'index_max', 's_weight')
+
+    def __init__(self, lower, upper, mass_weight, track_ids, index_min, index_max, s_weight):
+        self.lower, self.upper, self.mass_weight = lower, upper, mass_weight
+        self.track_ids, self.index_min, self.index_max, self.s_weight = track_ids, index_min, index_max, s_weight
+
+    def __len__(self):
+        return len(self.lower)
+
+class BracketCache:
+
+    """
+
+    Bounded LRU cache of HNNIBrackets, keyed by the catalog and the (test_mass, test_s) query values, so that the
+    HNNI of further target variables at the same queries skips the mass and s neighbor searches.
+
+    Usage:
+        >> cache = BracketCache(maxsize = 16)
+        >> values = HNNI_batch(catalog_index, test_masses, test_s, ['log_L'], cache = cache)
+        >> values = HNNI_batch(catalog_index, test_masses, test_s, ['log_Teff'], cache = cache)  # brackets reused
+        >> cache.hits, cache.misses
+
+    Catalogs are told apart by identity, by their ZAMS masses and by the version of a CatalogIndex (incremented by
+    CatalogIndex.update()); for a catalog_data dictionary, by the identity and length of each of its track data frames,
+    so that adding or replacing tracks (e.g. with MIST_catalog_update) invalidates its entries. Only after modifying
+    the values of a track data frame itself, call clear().
+    A CatalogIndex (and the track data frames of a catalog_data dictionary) are held through weak references, so that
+    the cache does not keep discarded catalogs in memory; a catalog_data dictionary itself (which cannot be weakly 
+    referenced) is kept alive by its entries until they are evicted, i.e. by at most maxsize entries.
+
+    Attributes:
+        maxsize         Maximum number of cached query sets.
+        hits            Number of lookups served from the cache.
+        misses          Number of lookups that computed the brackets.
+
+    """
+
+    def __init__(self, maxsize = 128):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def key(catalog, all_masses, test_masses, test_s):
+        digest = hashlib.sha1(all_masses.tobytes())
+        digest.update(np.ascontiguousarray(test_masses).tobytes())
+        digest.update(b'|')
+        digest.update(np.ascontiguousarray(test_s).tobytes())
+        if isinstance(catalog, dict):
+            digest.update(np.array([len(catalog[mass]) for mass in all_masses], dtype = 'int64').tobytes())
+        return (id(catalog), getattr(catalog, 'version', 0), digest.hexdigest())
+
+    # references to the catalog and, for a catalog_data dictionary, to its tracks (weak references where possible)
+    @staticmethod
+    def references(catalog, all_masses):
+        references = []
+        for obj in BracketCache._objects(catalog, all_masses):
+            try:
+                references.append(weakref.ref(obj))
+            except TypeError:
+                references.append(lambda obj = obj: obj)
+        return references
+
+    @staticmethod
+    def _objects(catalog, all_masses):
+        return [catalog] + ([catalog[mass] for mass in all_masses] if isinstance(catalog, dict) else [])
+
+    # cached brackets, or those returned by compute() (which are then cached)
+    def get(self, catalog, all_masses, test_masses, test_s, compute):
+        key = self.key(catalog, all_masses, test_masses, test_s)
+        with self._lock:
+            entry = self._entries.get(key)
+            # the entry refers to its catalog (and tracks), so that a new catalog or track with the id of a discarded one
+            # is not mistaken for it
+            if entry is not None and all(reference() is obj for reference, obj in zip(entry[0], self._objects(catalog, all_masses))):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        brackets = compute()
+        references = self.references(catalog, all_masses)
+        with self._lock:
+            self._entries[key] = (references, brackets)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last = False)
+        return brackets
+
+# global bracket cache of HNNI_batch and HNNI_grid (opt-in for HNNI_general)
+bracket_cache = BracketCache()
+
+# sorted ZAMS masses, per-track s values and per-track (s, target values) accessors of a catalog, given either as
+# a CatalogIndex or as a dictionary of data frames
+def _catalog_accessors(catalog):
+    if isinstance(catalog, CatalogIndex):
+        return catalog.masses, catalog.log_masses, catalog.track_s
+    all_masses = np.array(sorted(catalog.keys()), dtype = 'float64')
+    return all_masses, np.log10(all_masses), lambda track_id: np.asarray(catalog[all_masses[track_id]]["s"], dtype = 'float64')
+
+# mass and s brackets of (test_mass, test_s) queries on a catalog (a CatalogIndex or a dictionary of data frames)
+def HNNI_brackets(catalog, test_masses, test_s):
+    test_masses, test_s = np.broadcast_arrays(np.asarray(test_masses, dtype = 'float64').ravel(), np.asarray(test_s, dtype = 'float64').ravel())
+    all_masses, log_masses, track_s = _catalog_accessors(catalog)
+    return _compute_brackets(all_masses, log_masses, track_s, test_masses, test_s)
+
+def _compute_brackets(all_masses, log_masses, track_s, test_masses, test_s):
+    # upper and lower ZAMS mass grid points (indices into the sorted catalog masses)
+    n = len(test_masses)
+    with stage_stats.stage('HNNI_mass_neighbors', n):
+        lower, upper = neighbor_indices(all_masses, test_masses)
+        mass_weight = linear_weights(log_masses[lower], log_masses[upper], np.log10(test_masses))
     
-        # closest (from above and from below) s values to given test_s, at mmin and mmax
-        smin1_value, smin2_value = neighbor_points(np.array(smin_values), test_s)
-        smax1_value, smax2_value = neighbor_points(np.array(smax_values), test_s)
+    # s neighbors on both the lower and upper neighbor tracks
+    with stage_stats.stage('HNNI_s_brackets', 2*n):
+        track_ids = np.concatenate([lower, upper])
+        index_min, index_max, s_weight = s_brackets(track_s, track_ids, np.concatenate([test_s, test_s]))
+    return HNNIBrackets(lower, upper, mass_weight, track_ids, index_min, index_max, s_weight)
+
+# HNNI of the given target variables at the queries of precomputed brackets; returns an array of shape 
+# (number of queries, number of targets)
+def HNNI_apply(catalog, brackets, targets):
+    targets = [targets] if isinstance(targets, str) else list(targets)
+    n = len(brackets)
     
-        # get their indices (in mmin and mmax tracks at given test s)
-        index1_min = np.where(np.array(smin_values)==smin1_value) 
-        index1_max = np.where(np.array(smin_values)==smin2_value) 
-        index2_min = np.where(np.array(smax_values)==smax1_value)
-        index2_max = np.where(np.array(smax_values)==smax2_value)        
-
-        # interpolation along s axis
-        if not smin1_value == smin2_value:
-            target_s_min = linear_int(smin1_value, smin2_value, np.array(target_min_values)[index1_min], np.array(target_min_values)[index1_max], test_s)
-        elif smin1_value == smin2_value:
-            target_s_min = target_min_values[int(np.array(index1_min))]
-            
-        if not smax1_value == smax2_value:
-            target_s_max = linear_int(smax1_value, smax2_value, np.array(target_max_values)[index2_min], np.array(target_max_values)[index2_max], test_s)
-        
-        elif smax1_value == smax2_value:
-            target_s_max = target_max_values[int(np.array(index2_min))]
-        
-        # interpolation along log ZAMS mass axis
-        target_s = linear_int(np.log10(m_min), np.log10(m_max), target_s_min, target_s_max, np.log10(test_mass))
-         
+    # interpolation along s axis, on both the lower and upper neighbor tracks
+    with stage_stats.stage('HNNI_s_interpolation', 2*n):
+        if isinstance(catalog, CatalogIndex):
+            # a single gather over the catalog data block
+            target_columns = catalog.column_indices(targets)
+            rows_min = catalog.offsets[brackets.track_ids] + brackets.index_min
+            rows_max = catalog.offsets[brackets.track_ids] + brackets.index_max
+            values_min = catalog.data[np.ix_(target_columns, rows_min)].T
+            values_max = catalog.data[np.ix_(target_columns, rows_max)].T
+        else:
+            all_masses = np.array(sorted(catalog.keys()), dtype = 'float64')
+            values_min, values_max = np.empty((2*n, len(targets))), np.empty((2*n, len(targets)))
+            order = np.argsort(brackets.track_ids, kind = 'stable')
+            unique_ids, starts = np.unique(brackets.track_ids[order], return_index = True)
+            for track_id, query_rows in zip(unique_ids, np.split(order, starts[1:])):
+                target_values = catalog[all_masses[track_id]][targets].to_numpy(dtype = 'float64')
+                values_min[query_rows] = target_values[brackets.index_min[query_rows]]
+                values_max[query_rows] = target_values[brackets.index_max[query_rows]]
+        target_s = values_min + brackets.s_weight[:,np.newaxis]*(values_max - values_min)
+    target_s_min, target_s_max = target_s[:n], target_s[n:]
     
-    elif m_min == m_max:
-        s_values = catalog[m_min]["s"]
-        target_values = catalog[m_min][target]
-        smin_value, smax_value = neighbor_points(np.array(s_values), test_s)
-        index_min = np.where(np.array(s_values)==smin_value)
-        index_max = np.where(np.array(s_values)==smax_value)
-        if not index_min == index_max:
-            target_s = linear_int(smin_value, smax_value, np.array(target_values)[index_min], np.array(target_values)[index_max], test_s)
-        elif index_min == index_max:
-            target_s = target_values[int(np.array(index_min))] 
-    return float(target_s)
+    # interpolation along log ZAMS mass axis
+    with stage_stats.stage('HNNI_mass_interpolation', n):
+        values = target_s_min + brackets.mass_weight[:,np.newaxis]*(target_s_max - target_s_min)
+    return values
 
+# HNNI for many (test_mass, test_s) queries and several target variables at once, for a catalog given either as 
+# a CatalogIndex (preferred, built once from catalog_data) or as a dictionary of data frames;
+# the brackets of the queries are taken from the given BracketCache (cache=None to always recompute them);
+# returns an array of shape (number of queries, number of targets)
+def HNNI_batch(catalog, test_masses, test_s, targets, cache = bracket_cache):
+    test_masses, test_s = np.broadcast_arrays(np.asarray(test_masses, dtype = 'float64').ravel(), np.asarray(test_s, dtype = 'float64').ravel())
+    all_masses, log_masses, track_s = _catalog_accessors(catalog)
+    compute = lambda: _compute_brackets(all_masses, log_masses, track_s, test_masses, test_s)
+    brackets = compute() if cache is None else cache.get(catalog, all_masses, test_masses, test_s, compute)
+    return HNNI_apply(catalog, brackets, targets)
 
+# HNNI prediction of a single target variable at a single (test_mass, test_s) point,
+# for a catalog given either as a dictionary of data frames or as a CatalogIndex;
+# the brackets of single points are not cached by default (per-point cache entries are rarely reused, e.g. when the
+# targets are looped over outside of the s values), pass a BracketCache to cache them
+def HNNI_general(catalog, test_mass, test_s, target, cache = None):
+    if cache is None and not isinstance(catalog, CatalogIndex):
+        return _HNNI_point(catalog, float(test_mass), float(test_s), target)
+    return float(HNNI_batch(catalog, test_mass, test_s, [target], cache)[0,0])
 
+# scalar HNNI on a dictionary of data frames: only the two neighbor tracks are searched and only the target column
+# is read, with the same brackets and weights as HNNI_batch
+def _HNNI_point(catalog, test_mass, test_s, target):
+    all_masses = sorted(catalog.keys())
+    upper = min(bisect.bisect_left(all_masses, test_mass), len(all_masses)-1)
+    lower = max(bisect.bisect_right(all_masses, test_mass) - 1, 0)
+    target_s = []
+    for mass in ([all_masses[lower]] if lower == upper else [all_masses[lower], all_masses[upper]]):
+        track = catalog[mass]
+        s_values = track['s'].to_numpy()
+        index_max = min(int(np.searchsorted(s_values, test_s, side = 'left')), len(s_values)-1)
+        index_min = max(int(np.searchsorted(s_values, test_s, side = 'right')) - 1, 0)
+        target_values = track[target].to_numpy()
+        value_min, value_max = float(target_values[index_min]), float(target_values[index_max])
+        target_s.append(value_min + _point_weight(float(s_values[index_min]), float(s_values[index_max]), test_s)*(value_max - value_min))
+    if lower == upper:
+        return target_s[0]
+    log_masses = np.log10([all_masses[lower], all_masses[upper], test_mass])
+    return target_s[0] + _point_weight(log_masses[0], log_masses[1], log_masses[2])*(target_s[1] - target_s[0])
+
+# scalar version of linear_weights
+def _point_weight(x_lower, x_upper, x):
+    dx = x_upper - x_lower
+    return float((x - x_lower)/dx) if dx != 0 else 0.
 
+####################################################################################################
+######################################### Parallel HNNI ############################################
+####################################################################################################
 
+# catalog of the HNNI worker processes, set once per process (inherited when forked, otherwise pickled once per worker)
+_worker_catalog = None
+_worker_loo = {}
 
+def _init_HNNI_worker(catalog):
+    global _worker_catalog
+    _worker_catalog = catalog
+    _worker_loo.clear()
 
+# HNNI of a work unit: all targets at the s values test_s of the ZAMS mass test_mass, with the track of that mass 
+# left out of the catalog if leave_one_out is set
+def _HNNI_unit(test_mass, test_s, targets, leave_one_out):
+    catalog = _worker_catalog
+    if leave_one_out:
+        if test_mass not in _worker_loo:
+            _worker_loo.clear()
+            _worker_loo[test_mass] = catalog.without(test_mass)
+        catalog = _worker_loo[test_mass]
+    return HNNI_batch(catalog, test_mass, test_s, targets, cache = None)
 
+# HNNI predictions of the targets along whole tracks, for a dictionary of ZAMS masses and s values (e.g. 
+# {mass: test_masses_df[mass]["s"] for mass in initial_massesEEP}), split into work units of at most chunk_size 
+# queries that are evaluated by a pool of n_jobs processes (n_jobs=None for all cores, n_jobs=1 for no pool);
+# a dictionary catalog is converted into a CatalogIndex once, which is inherited by the forked workers (or pickled 
+# once per worker where processes are spawned), and a CatalogStore grid is reopened from its file by each worker.
+# With leave_one_out=True, the track of each test mass is excluded from the catalog used for that mass (one work 
+# unit per mass). Returns a dictionary of data frames with the targets and s, as HNNI_pred_dict in the notebook
+def HNNI_tracks_parallel(catalog, test_s_values, targets, n_jobs = None, chunk_size = 4096, leave_one_out = False):
+    targets = [targets] if isinstance(targets, str) else list(targets)
+    if not isinstance(catalog, CatalogIndex):
+        catalog = CatalogIndex.from_catalog(catalog, ['s'] + targets)
+    test_s_values = {mass: np.asarray(s_values, dtype = 'float64').ravel() for mass, s_values in test_s_values.items()}
+    
+    # work units (mass, first and last query index)
+    units = []
+    for mass, s_values in test_s_values.items():
+        step = max(len(s_values), 1) if leave_one_out else chunk_size
+        units += [(mass, start, min(start + step, len(s_values))) for start in range(0, len(s_values), step)]
+    
+    results = {mass: np.empty((len(s_values), len(targets))) for mass, s_values in test_s_values.items()}
+    if n_jobs == 1:
+        _init_HNNI_worker(catalog)
+        try:
+            for mass, start, stop in units:
+                results[mass][start:stop] = _HNNI_unit(mass, test_s_values[mass][start:stop], targets, leave_one_out)
+        finally:
+            _init_HNNI_worker(None)
+    else:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+        with ProcessPoolExecutor(max_workers = n_jobs, mp_context = context, initializer = _init_HNNI_worker, initargs = (catalog,)) as pool:
+            futures = [(unit, pool.submit(_HNNI_unit, unit[0], test_s_values[unit[0]][unit[1]:unit[2]], targets, leave_one_out)) for unit in units]
+            for (mass, start, stop), future in futures:
+                results[mass][start:stop] = future.result()
+    
+    HNNI_pred_dict = {}
+    for mass, values in results.items():
+        HNNI_pred = pd.DataFrame(values, columns = targets)
+        HNNI_pred["s"] = test_s_values[mass]
+        HNNI_pred_dict[mass] = HNNI_pred
+    return HNNI_pred_dict
 
+####################################################################################################
+###################################### Multi-dimensional HNNI ######################################
+####################################################################################################
 
+# HNNI over the ZAMS mass and further grid axes (e.g. [Fe/H] and v/vcrit): grids is a dictionary (or a CatalogStore) of 
+# grid keys, i.e. tuples of the grid parameters such as ([Fe/H], v/vcrit) as returned by MIST_grid_reader, and catalogs;
+# test_params holds the grid parameters of each query, with shape (number of queries, number of grid parameters).
+# Along each grid axis, the lower and upper neighbor grids are found (clamped at the grid edges, as for the ZAMS mass),
+# and on each of the resulting 2^(d-1) neighbor grids, HNNI_batch interpolates on its two mass neighbor tracks 
+# (2^d tracks in total); the grid values are then interpolated linearly along each grid axis in turn.
+# The grid keys must form a complete rectilinear grid (at least around the queries).
+# Returns an array of shape (number of queries, number of targets)
+def HNNI_grid(grids, test_masses, test_s, test_params, targets, cache = bracket_cache):
+    targets = [targets] if isinstance(targets, str) else list(targets)
+    keys = np.array(sorted(grids.keys()), dtype = 'float64').reshape(len(grids), -1)
+    n_axes = keys.shape[1]
+    test_params = np.atleast_2d(np.asarray(test_params, dtype = 'float64'))
+    if test_params.shape[-1] != n_axes:
+        test_params = test_params.reshape(-1, n_axes)
+    test_masses, test_s, query_rows = np.broadcast_arrays(np.asarray(test_masses, dtype = 'float64').ravel(), 
+                                                          np.asarray(test_s, dtype = 'float64').ravel(), 
+                                                          np.arange(len(test_params)))
+    test_params = test_params[query_rows]
+    n = len(test_masses)
+    
+    # lower and upper neighbors along each grid axis, with the weights of the upper ones
+    with stage_stats.stage('HNNI_grid_neighbors', n):
+        axis_values = [np.unique(keys[:,a]) for a in range(n_axes)]
+        axis_lower, axis_upper, axis_weight = [], [], []
+        for a in range(n_axes):
+            lower, upper = neighbor_indices(axis_values[a], test_params[:,a])
+            axis_lower.append(lower)
+            axis_upper.append(upper)
+            axis_weight.append(linear_weights(axis_values[a][lower], axis_values[a][upper], test_params[:,a]))
+    
+    # multilinear combination over the corners of the grid cell of each query
+    values = np.zeros((n, len(targets)))
+    for corner in itertools.product([False, True], repeat = n_axes):
+        indices = [np.where(upper_side, axis_upper[a], axis_lower[a]) for a, upper_side in enumerate(corner)]
+        weight = np.ones(n)
+        for a, upper_side in enumerate(corner):
+            weight *= axis_weight[a] if upper_side else 1. - axis_weight[a]
+        # corners of zero weight are skipped, so that grids beyond the edges (or on a query's grid point) are not needed
+        used = weight != 0
+        if not np.any(used):
+            continue
+        codes = np.ravel_multi_index([index[used] for index in indices], [len(v) for v in axis_values])
+        unique_codes, inverse = np.unique(codes, return_inverse = True)
+        used_rows = np.flatnonzero(used)
+        for code, grid_index in enumerate(zip(*np.unravel_index(unique_codes, [len(v) for v in axis_values]))):
+            key = tuple(float(axis_values[a][i]) for a, i in enumerate(grid_index))
+            if key not in grids:
+                raise KeyError('grid ' + str(key) + ' is missing: the grid keys must form a complete rectilinear grid')
+            rows = used_rows[inverse == code]
+            values[rows] += weight[rows,np.newaxis]*HNNI_batch(grids[key], test_masses[rows], test_s[rows], targets, cache)
+    return values
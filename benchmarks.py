@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+# Benchmarks of the emulator and HNNI hot paths, runnable without the MIST catalog (synthetic EEP tracks are generated
+# in a temporary directory). Results are saved as JSON and can be compared against a stored baseline:
+#
+#   python benchmarks.py --save-baseline benchmark_baseline.json
+#   python benchmarks.py --baseline benchmark_baseline.json --output benchmark_results.json
+#
+# The comparison reports the throughput (items per second) of each benchmark relative to the baseline, and the script
+# exits with status 1 if any benchmark is slower than the baseline by more than the given threshold.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+repo_path = os.path.dirname(os.path.abspath(__file__))
+
+####################################################################################################
+####################################### Synthetic EEP tracks #######################################
+####################################################################################################
+
+# columns of the synthetic tracks: the basic columns of HNNI_routines.py, plus filler columns up to the width of MIST tracks
+synthetic_columns = ['star_age', 'star_mass', 'log_L', 'log_Teff', 'log_g', 'log_center_T', 'log_center_Rho', 'center_he4', 'phase']
+synthetic_columns += ['column_%d' % i for i in range(77 - len(synthetic_columns))]
+
+# writes a track in the MIST .track.eep format, with a PMS, MS, RGB, CHeB, EAGB and (for massive stars) WR sequence
+def write_synthetic_eep(filename, initial_mass, n_points = 1500, seed = 0):
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 1, n_points)
+    phase = np.select([x < 0.1, x < 0.6, x < 0.7, x < 0.9], [-1., 0., 2., 3.], 9. if initial_mass >= 60 else 4.)
+    data = rng.normal(size = (n_points, len(synthetic_columns)))
+    values = {
+        'star_age': 1e5 + 1e10*initial_mass**-2.5*x**2,
+        'star_mass': initial_mass*(1 - 0.1*x),
+        'log_L': 3.5*np.log10(initial_mass) + np.sin(6*x) + 0.01*np.cumsum(rng.normal(size = n_points))/np.sqrt(n_points),
+        'log_Teff': 3.76 + 0.15*np.log10(initial_mass) - 0.3*x**2,
+        'log_g': 4.4 - 2*x,
+        'log_center_T': 7.1 + 0.1*np.log10(initial_mass) + x,
+        'log_center_Rho': 2 - 0.3*np.log10(initial_mass) + 2*x**2,
+        'center_he4': np.clip(1.5 - 1.5*x, 0, 1),
+        'phase': phase,
+    }
+    for name in values:
+        data[:, synthetic_columns.index(name)] = values[name]
+    with open(filename, 'w') as f:
+        f.write('# MIST version number  = 1.2\n# MESA revision number =     7503\n# ' + '-'*86 + '\n')
+        f.write('#  Yinit        Zinit   [Fe/H]   [a/Fe]  v/vcrit\n#  0.2703  1.42857E-02    0.00     0.00     0.00\n# ' + '-'*86 + '\n')
+        f.write('#  initial_mass   N_pts   N_EEP   N_col   phase        type\n')
+        f.write('#  %16.7E %8d       9 %7d     YES    synthetic\n' % (initial_mass, n_points, len(synthetic_columns)))
+        f.write('#  EEPs:    1     202     353     454     605     631     707     808    1409\n# ' + '-'*86 + '\n')
+        f.write('#' + ''.join('%32d' % (i+1) for i in range(len(synthetic_columns))) + '\n')
+        f.write('#' + ''.join('%32s' % name for name in synthetic_columns) + '\n')
+        np.savetxt(f, data, fmt = '%32.16E', delimiter = '')
+
+# writes n_tracks synthetic tracks with ZAMS masses log-uniformly spaced in (0.7, 300), returns the mass-name dictionary
+def write_synthetic_catalog(path, n_tracks, n_points = 1500):
+    mass_name = {}
+    for i, initial_mass in enumerate(np.round(np.logspace(np.log10(0.7), np.log10(300.), n_tracks), 4)):
+        mass_name[float(initial_mass)] = '%07dM' % int(round(initial_mass*1e4))
+        write_synthetic_eep(os.path.join(path, mass_name[float(initial_mass)] + '.track.eep'), initial_mass, n_points, seed = i)
+    return mass_name
+
+####################################################################################################
+############################################# Benchmarks ###########################################
+####################################################################################################
+
+# best-of-repeat wall time of a call
+def best_time(function, repeat):
+    times = []
+    for i in range(repeat):
+        StartTime = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - StartTime)
+    return min(times)
+
+# each benchmark returns a function to time and the number of items (stars, track points, queries, ...) it processes
+def emulator_benchmarks(emulator, scale):
+    rng = np.random.default_rng(0)
+    n_stars = int(2e5*scale)
+    test_ages = 10**rng.uniform(6, 10, n_stars)
+    log_M_ZAMS = rng.uniform(np.log10(0.7), np.log10(300.), n_stars)
+    M_ZAMS_range = np.logspace(np.log10(0.7), np.log10(300.), max(int(150*scale), 2))
+    s_sampling = np.arange(0, 1.01, 0.01)
+    log_Mini = np.arange(np.log10(0.7), np.log10(300.), 0.0005/scale)
+    iso_values = [1e+6, 1e+7, 1e+8, 1e+9, 1e+10]
+    n_calls = max(int(200*scale), 1)
+
+    from stellar_evolution_emulator import HR_and_Kiel_tracks, HR_and_Kiel_tracks_adaptive, observables_fixed_tau_MZAMS, observables_population, isochrone_computation
+    models = (emulator.age_modelTA, emulator.age_modelTE, emulator.knn_model, emulator.ffNN)
+    return {
+        'HR_and_Kiel_tracks': (lambda: HR_and_Kiel_tracks(M_ZAMS_range, s_sampling, emulator.ffNN), len(M_ZAMS_range)*len(s_sampling)),
+        'HR_and_Kiel_tracks_adaptive': (lambda: HR_and_Kiel_tracks_adaptive(M_ZAMS_range, emulator.ffNN), len(M_ZAMS_range)),
+        'observables_fixed_tau_MZAMS': (lambda: [observables_fixed_tau_MZAMS(test_ages[i], log_M_ZAMS[i], *models) for i in range(n_calls)], n_calls),
+        'observables_population': (lambda: observables_population(test_ages, log_M_ZAMS, *models), n_stars),
+        'isochrone_computation': (lambda: isochrone_computation(log_Mini, iso_values, *models), len(log_Mini)*len(iso_values)),
+    }
+
+# number of ffNN evaluations of the adaptive s-sampling per track, and of the smallest uniform s-sampling that reaches 
+# the same maximum step in the (logL, logTeff, logg) space
+def adaptive_sampling_comparison(emulator, tol = 0.02, masses = (1., 5., 20., 100.)):
+    from stellar_evolution_emulator import HR_and_Kiel_tracks, HR_and_Kiel_tracks_adaptive
+    max_step = lambda track: np.max(np.sqrt(np.sum(np.diff(track, axis = 0)**2, axis = 1)))
+    comparison = {}
+    for M_ZAMS in masses:
+        s_values, track = HR_and_Kiel_tracks_adaptive([M_ZAMS], emulator.ffNN, tol = tol)[0]
+        target = max_step(track)
+        lower, upper = 2, 2
+        while max_step(HR_and_Kiel_tracks([M_ZAMS], np.linspace(0, 1, upper), emulator.ffNN)[0]) > target:
+            lower, upper = upper, 2*upper
+        while lower < upper:
+            middle = (lower + upper)//2
+            if max_step(HR_and_Kiel_tracks([M_ZAMS], np.linspace(0, 1, middle), emulator.ffNN)[0]) <= target:
+                upper = middle
+            else:
+                lower = middle + 1
+        comparison[str(M_ZAMS)] = {'adaptive_points': len(s_values), 'uniform_points': upper, 'max_step': target}
+    return comparison
+
+def catalog_benchmarks(path, scale):
+    import processing_and_plot_routines as P
+    import HNNI_routines as H
+
+    n_tracks = max(int(40*scale), 4)
+    mass_name = write_synthetic_catalog(path, n_tracks)
+    masses = list(mass_name.keys())
+    phases_list, basic_columns = H.phases_list, H.basic_columns
+    eep_filename = os.path.join(path, mass_name[masses[0]] + '.track.eep')
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        catalog_data = P.MIST_data_reader(masses, mass_name, path, phases_list, basic_columns)
+    catalog_index = H.CatalogIndex.from_catalog(catalog_data)
+    track = catalog_data[masses[0]]
+
+    rng = np.random.default_rng(0)
+    n_queries = int(2e5*scale)
+    test_masses = rng.uniform(0.7, 300., n_queries)
+    test_s = rng.uniform(0, 1, n_queries)
+    targets = ['log_L', 'log_Teff', 'log_center_T', 'log_center_Rho']
+    n_calls = max(int(500*scale), 1)
+
+    def read_catalog(cache):
+        with contextlib.redirect_stdout(io.StringIO()):
+            P.MIST_data_reader(masses, mass_name, path, phases_list, basic_columns, cache = cache)
+    read_catalog(cache = True) # writes the binary cache
+
+    return {
+        'EEP_parse': (lambda: P.eep_read1.EEP(eep_filename, verbose = False), 1),
+        'EEP_parse_basic_columns': (lambda: P.eep_read1.EEP(eep_filename, verbose = False, columns = basic_columns), 1),
+        'MIST_data_reader': (lambda: read_catalog(cache = False), n_tracks),
+        'MIST_data_reader_cached': (lambda: read_catalog(cache = True), n_tracks),
+        'Axes3_proxy': (lambda: P.Axes3_proxy(track['log_L'], track['log_Teff'], track['log_center_Rho']), len(track)),
+        'HNNI_general': (lambda: [H.HNNI_general(catalog_index, test_masses[i], test_s[i], 'log_L', cache = None) for i in range(n_calls)], n_calls),
+        'HNNI_general_catalog_data': (lambda: [H.HNNI_general(catalog_data, test_masses[i], test_s[i], 'log_L') for i in range(n_calls)], n_calls),
+        'HNNI_batch': (lambda: H.HNNI_batch(catalog_index, test_masses, test_s, targets, cache = None), n_queries*len(targets)),
+        # one target per call, as in the HNNI notebook, with the brackets computed once and reused for the other targets
+        'HNNI_batch_per_target_cached': (lambda: [H.HNNI_batch(catalog_index, test_masses, test_s, [target], cache = cache) 
+                                                  for cache in [H.BracketCache(1)] for target in targets], n_queries*len(targets)),
+    }
+
+def run_benchmarks(scale = 1., repeat = 3, only = None, emulator_kwargs = None, log = print):
+    from stellar_evolution_emulator import Emulator
+    results, adaptive_sampling = {}, {}
+    with tempfile.TemporaryDirectory() as path:
+        emulator = Emulator(os.path.join(repo_path, 'models'), **(emulator_kwargs or {}))
+        emulator.load_all()
+        benchmarks = emulator_benchmarks(emulator, scale)
+        benchmarks.update(catalog_benchmarks(path, scale))
+        for name, (function, n_items) in benchmarks.items():
+            if only and name not in only:
+                continue
+            function() # warm-up
+            seconds = best_time(function, repeat)
+            results[name] = {'seconds': seconds, 'items': n_items, 'throughput': n_items/seconds}
+            log('%-30s %12.4f s %14.1f items/s' % (name, seconds, n_items/seconds))
+        if not only or 'HR_and_Kiel_tracks_adaptive' in only:
+            adaptive_sampling = adaptive_sampling_comparison(emulator)
+            for M_ZAMS, counts in adaptive_sampling.items():
+                log('adaptive sampling, M_ZAMS = %-7s %6d points (uniform sampling with the same max step: %d points)' 
+                    % (M_ZAMS, counts['adaptive_points'], counts['uniform_points']))
+    return {'metadata': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(), 'numpy': np.__version__,
+                         'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'scale': scale, 'repeat': repeat,
+                         'backends': {'ffNN': emulator.ffNN_backend, 'age': emulator.age_backend, 'knn': emulator.knn_backend}},
+            'results': results, 'adaptive_sampling': adaptive_sampling}
+
+# relative throughput of each benchmark with respect to the baseline, and the names of the regressed benchmarks
+def compare_to_baseline(results, baseline, threshold = 0.2):
+    ratios, regressions = {}, []
+    for name, result in results['results'].items():
+        if name in baseline['results']:
+            ratios[name] = result['throughput']/baseline['results'][name]['throughput']
+            if ratios[name] < 1 - threshold:
+                regressions.append(name)
+    return ratios, regressions
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmarks of the stellar evolution emulator and HNNI hot paths.')
+    parser.add_argument('--output', help = 'JSON file for the benchmark results')
+    parser.add_argument('--baseline', help = 'JSON file with baseline results to compare against')
+    parser.add_argument('--save-baseline', help = 'JSON file to store the results as the new baseline')
+    parser.add_argument('--threshold', type = float, default = 0.2, help = 'tolerated relative throughput loss (default: 0.2)')
+    parser.add_argument('--scale', type = float, default = 1., help = 'problem size factor (default: 1)')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'number of timed repetitions, best is kept (default: 3)')
+    parser.add_argument('--only', nargs = '+', help = 'names of the benchmarks to run')
+    parser.add_argument('--ffNN-backend', default = 'auto', choices = ['auto', 'numpy', 'keras'])
+    parser.add_argument('--age-backend', default = 'auto', choices = ['auto', 'table', 'gpr'])
+    parser.add_argument('--knn-backend', default = 'auto', choices = ['auto', 'kdtree', 'sklearn'])
+    args = parser.parse_args(argv)
+
+    # the HNNI routines and the emulator read their data files relative to the repository
+    os.chdir(repo_path)
+    sys.path.insert(0, repo_path)
+    results = run_benchmarks(args.scale, args.repeat, args.only,
+                             {'ffNN_backend': args.ffNN_backend, 'age_backend': args.age_backend, 'knn_backend': args.knn_backend})
+    for filename in [args.output, args.save_baseline]:
+        if filename:
+            with open(filename, 'w') as f:
+                json.dump(results, f, indent = 1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        ratios, regressions = compare_to_baseline(results, baseline, args.threshold)
+        print('\nthroughput relative to baseline (' + args.baseline + '):')
+        for name, ratio in ratios.items():
+            print('%-30s %8.2fx%s' % (name, ratio, '   REGRESSION' if name in regressions else ''))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+####################################################################################################
+###################################### Chunked, resumable output ###################################
+####################################################################################################
+
+# Data frame chunks (e.g. from isochrone_chunks or HR_and_Kiel_track_chunks in stellar_evolution_emulator.py) are written
+# either to a Parquet directory (one part-NNNNN.parquet file per chunk, plus a manifest.json) or to a single HDF5 file
+# (appended to a pandas HDFStore table). After each chunk the number of completed chunks is recorded, so that an
+# interrupted run resumes from the last completed chunk, as long as it is started with the same parameters.
+
+hdf5_extensions = ('.h5', '.hdf5', '.hdf')
+
+# fingerprint of the input arrays of a run (to detect when an existing output was written with other inputs)
+def array_digest(*arrays):
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array, dtype = 'float64')
+        digest.update(str(array.shape).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+def output_format(path, format = None):
+    if format is None:
+        format = 'hdf5' if path.lower().endswith(hdf5_extensions) else 'parquet'
+    if format not in ['parquet', 'hdf5']:
+        raise ValueError("format must be one of 'parquet', 'hdf5'")
+    return format
+
+# writes the chunks returned by chunk_generator(start_chunk) to path, and returns the total number of chunks;
+# parameters is a JSON-serializable dictionary that identifies the run (an existing output written with other
+# parameters raises a ValueError), resume=False discards an existing output
+def write_chunks(path, chunk_generator, parameters, format = None, resume = True, key = 'data'):
+    format = output_format(path, format)
+    parameters = json.loads(json.dumps(parameters))
+    if format == 'parquet':
+        return _write_parquet_chunks(path, chunk_generator, parameters, resume)
+    return _write_hdf5_chunks(path, chunk_generator, parameters, resume, key)
+
+# progress of an output written with write_chunks: the run parameters, number of completed chunks and rows,
+# and whether the run has finished (None if there is no output at path, or if no chunk of it was completed)
+def chunks_status(path, format = None, key = 'data'):
+    format = output_format(path, format)
+    if format == 'parquet':
+        manifest_file = os.path.join(path, 'manifest.json')
+        if not os.path.exists(manifest_file):
+            return None
+        with open(manifest_file) as f:
+            return json.load(f)
+    import pandas as pd
+    if not os.path.exists(path):
+        return None
+    with pd.HDFStore(path, mode = 'r') as store:
+        if key not in store:
+            return None
+        # the status is written after the first chunk was appended, a run interrupted in between has none
+        chunks_status = getattr(store.get_storer(key).attrs, 'chunks_status', None)
+        return None if chunks_status is None else json.loads(chunks_status)
+
+# reads the completed chunks of an output written with write_chunks into a single data frame
+def read_chunks(path, format = None, key = 'data', columns = None):
+    import pandas as pd
+    format = output_format(path, format)
+    if not os.path.exists(path):
+        raise FileNotFoundError('no chunked output found at ' + path)
+    status = chunks_status(path, format, key)
+    if status is None:
+        return pd.DataFrame(columns = columns)
+    if format == 'parquet':
+        parts = [pd.read_parquet(_part_filename(path, i), columns = columns) for i in range(status['n_chunks'])]
+        return pd.concat(parts) if len(parts) > 0 else pd.DataFrame(columns = columns)
+    return pd.read_hdf(path, key, columns = columns, stop = status['n_rows'])
+
+def _part_filename(path, chunk_index):
+    return os.path.join(path, 'part-%05d.parquet' % chunk_index)
+
+# checks an existing status against the parameters of the run, and returns the status to continue from
+def _resume_status(status, parameters, resume, path):
+    if status is not None and resume:
+        if status['parameters'] != parameters:
+            raise ValueError('the output at ' + path + ' was written with other parameters; use resume=False to overwrite it')
+        return status
+    return {'parameters': parameters, 'n_chunks': 0, 'n_rows': 0, 'complete': False}
+
+def _write_parquet_chunks(path, chunk_generator, parameters, resume):
+    manifest_file = os.path.join(path, 'manifest.json')
+    status = chunks_status(path, 'parquet')
+    status = _resume_status(status, parameters, resume, path)
+    os.makedirs(path, exist_ok = True)
+
+    def save_status():
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump(status, f)
+        os.replace(manifest_file + '.tmp', manifest_file)
+
+    if not status['complete']:
+        for chunk in chunk_generator(status['n_chunks']):
+            # the part file is renamed into place only once it is fully written, and counted only after that
+            part_file = _part_filename(path, status['n_chunks'])
+            chunk.to_parquet(part_file + '.tmp', index = True)
+            os.replace(part_file + '.tmp', part_file)
+            status['n_chunks'] += 1
+            status['n_rows'] += len(chunk)
+            save_status()
+        status['complete'] = True
+        save_status()
+    return status['n_chunks']
+
+def _write_hdf5_chunks(path, chunk_generator, parameters, resume, key):
+    import pandas as pd
+    status = chunks_status(path, 'hdf5', key) if resume else None
+    status = _resume_status(status, parameters, resume, path)
+    with pd.HDFStore(path, mode = 'a') as store:
+        if status['n_chunks'] == 0 and key in store:
+            store.remove(key)
+        elif key in store and store.get_storer(key).nrows > status['n_rows']:
+            # rows of a chunk that was interrupted while being appended
+            store.remove(key, start = status['n_rows'], stop = store.get_storer(key).nrows)
+
+        if not status['complete']:
+            for chunk in chunk_generator(status['n_chunks']):
+                store.append(key, chunk, format = 'table')
+                status['n_chunks'] += 1
+                status['n_rows'] += len(chunk)
+                store.get_storer(key).attrs.chunks_status = json.dumps(status)
+                store.flush(fsync = True)
+            status['complete'] = True
+            if key in store:
+                store.get_storer(key).attrs.chunks_status = json.dumps(status)
+    return status['n_chunks']
@@ -1,7 +1,30 @@
 from __future__ import print_function
 import numpy as np
+import json
+import os
 import matplotlib.pyplot as plt
        
+def read_eep_header(filename):
+    
+    """
+    Reads in the header lines (metadata & column names) of an EEP file, without reading the data.
+    
+    Returns:
+        version, abun, rot, minit, hdr_list (see the EEP attributes)
+    
+    """
+    
+    with open(filename) as f:
+        content = [f.readline().split() for i in range(12)]
+
+    version = {'MIST': content[0][-1], 'MESA': content[1][-1]}
+    abun = {content[3][i]:float(content[4][i]) for i in range(1,5)}
+    rot = float(content[4][-1])
+    minit = float(content[7][1])
+    hdr_list = content[11][1:]
+    
+    return version, abun, rot, minit, hdr_list
+
 class EEP:
     
     """
@@ -10,16 +33,21 @@ class EEP:
     
     """
     
-    def __init__(self, filename, verbose=True):
+    def __init__(self, filename, verbose=True, columns=None, cache=False):
         
         """
         
         Args:
             filename: the name of .track.eep file.
+            columns: list of the column names to load (default: all columns).
+            cache: if True, the track is read from (or, if missing or outdated, written to) a binary cache file
+                   next to the .track.eep file (filename + '.npz'). The cache holds all columns and is
+                   invalidated when the modification time or size of the .track.eep file changes.
         
         Usage:
             >> eep = read_mist_models.EEP('00200M.track.eep')
             >> logTeff, center_h1, mdot = eep.eeps['log_Teff'], eep['center_h1'], eep['star_mdot']
+            >> eep = read_mist_models.EEP('00200M.track.eep', columns=['log_L', 'log_Teff', 'phase'], cache=True)
             
         Attributes:
             version         Dictionary containing the MIST and MESA version numbers.
@@ -27,16 +55,66 @@ class EEP:
             rot             Rotation in units of surface v/v_crit.
             minit           Initial mass in solar masses.
             hdr_list        List of column headers.
-            eeps            Data.
+            eeps            Data (structured array, with the loaded columns only).
             
         """
                         
         self.filename = filename
+        self.columns = columns
+        self.cache = cache
         if verbose:
             print('Reading in: ' + self.filename)
                         
         self.version, self.abun, self.rot, self.minit, self.hdr_list, self.eeps = self.read_eep_file()
         
+    def read_eep_header(self):
+        
+        """
+        Reads in the header lines (metadata & column names) of the EEP file.
+                
+        """
+        
+        return read_eep_header(self.filename)
+    
+    def cache_filename(self):
+        return self.filename + '.npz'
+    
+    def read_eep_cache(self, columns):
+        
+        """
+        Reads in the requested columns from the binary cache, or returns None if there is no valid cache.
+                
+        """
+        
+        stat = os.stat(self.filename)
+        try:
+            with np.load(self.cache_filename()) as cache:
+                if (int(cache['source_mtime_ns']) != stat.st_mtime_ns) or (int(cache['source_size']) != stat.st_size):
+                    return None
+                header = json.loads(str(cache['header']))
+                if columns is None:
+                    columns = header['hdr_list']
+                data = [cache['column:' + name] for name in columns]
+        except (OSError, KeyError, ValueError):
+            return None
+        
+        return header['version'], header['abun'], header['rot'], header['minit'], header['hdr_list'], columns, data
+    
+    def write_eep_cache(self, version, abun, rot, minit, hdr_list, data):
+        
+        """
+        Writes all columns of the track to the binary cache (atomically, via a temporary file).
+                
+        """
+        
+        stat = os.stat(self.filename)
+        header = json.dumps({'version': version, 'abun': abun, 'rot': rot, 'minit': minit, 'hdr_list': hdr_list})
+        arrays = {'column:' + name: np.ascontiguousarray(data[:, i]) for i, name in enumerate(hdr_list)}
+        tmp_filename = self.cache_filename() + '.%d.tmp' % os.getpid()
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f, header=header, source_mtime_ns=stat.st_mtime_ns, source_size=stat.st_size, **arrays)
+        os.replace(tmp_filename, self.cache_filename())
+    
     def read_eep_file(self):
         
         """
@@ -47,16 +125,27 @@ class EEP:
                 
         """
         
-        eeps = np.genfromtxt(self.filename, skip_header=11, names=True)
+        cached = self.read_eep_cache(self.columns) if self.cache else None
+        if cached is not None:
+            version, abun, rot, minit, hdr_list, columns, data = cached
+        else:
+            version, abun, rot, minit, hdr_list = self.read_eep_header()
+            columns = hdr_list if self.columns is None else list(self.columns)
+            missing = [name for name in columns if name not in hdr_list]
+            if missing:
+                raise KeyError(self.filename + ' has no columns ' + ', '.join(missing))
+            
+            # the cache always holds all columns, otherwise only the requested ones are parsed
+            usecols = None if self.cache else [hdr_list.index(name) for name in columns]
+            table = np.loadtxt(self.filename, comments='#', usecols=usecols, ndmin=2)
+            if self.cache:
+                self.write_eep_cache(version, abun, rot, minit, hdr_list, table)
+                table = table[:, [hdr_list.index(name) for name in columns]]
+            data = [table[:, i] for i in range(len(columns))]
         
-        with open(self.filename) as f:
-            content = [line.split() for line in f]
-
-        version = {'MIST': content[0][-1], 'MESA': content[1][-1]}
-        abun = {content[3][i]:float(content[4][i]) for i in range(1,5)}
-        rot = float(content[4][-1])
-        minit = float(content[7][1])
-        hdr_list = content[11][1:]
+        eeps = np.empty(len(data[0]) if data else 0, dtype=[(name, 'f8') for name in columns])
+        for name, values in zip(columns, data):
+            eeps[name] = values
         
         return version, abun, rot, minit, hdr_list, eeps
         		
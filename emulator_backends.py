@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+####################################################################################################
+###################################### NumPy backend of the ffNN ###################################
+####################################################################################################
+
+# activation functions of the Dense layers supported by the NumPy forward pass
+ffNN_activations = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0, out = x),
+    'tanh': np.tanh,
+    'sigmoid': lambda x: 1./(1. + np.exp(-x)),
+}
+
+# export of the ffNN weights (Dense and LayerNormalization layers, in order) to a compact .npz file
+def export_ffNN_weights(ffNN, filename = 'models/ffNN_weights.npz'):
+    kinds, activations, epsilons, weights = [], [], [], {}
+    for layer in ffNN.layers:
+        layer_type = type(layer).__name__
+        config = layer.get_config()
+        if layer_type in ['InputLayer', 'Dropout']:
+            # no-ops at inference time
+            continue
+        elif layer_type == 'Dense':
+            if config['activation'] not in ffNN_activations:
+                raise ValueError('unsupported activation in layer ' + layer.name + ': ' + str(config['activation']))
+            activations.append(config['activation'])
+            epsilons.append(0.)
+        elif layer_type == 'LayerNormalization':
+            if not (config['center'] and config['scale']) or list(np.ravel(config['axis'])) not in [[-1], [1]]:
+                raise ValueError('unsupported LayerNormalization configuration in layer ' + layer.name)
+            activations.append('')
+            epsilons.append(config['epsilon'])
+        else:
+            raise ValueError('unsupported layer type: ' + layer_type)
+        # kernel & bias (Dense), or gamma & beta (LayerNormalization)
+        w0, w1 = layer.get_weights()
+        weights['w0_%d' % len(kinds)], weights['w1_%d' % len(kinds)] = w0, w1
+        kinds.append(layer_type)
+    np.savez(filename, kinds = np.array(kinds), activations = np.array(activations), epsilons = np.array(epsilons), **weights)
+
+class NumpyFFNN:
+
+    """
+
+    Forward pass of the ffNN surrogate in pure NumPy, from the weights exported with export_ffNN_weights().
+
+    Usage:
+        >> ffNN = NumpyFFNN('models/ffNN_weights.npz')
+        >> logL_logTeff_logg = ffNN.predict(np.array([[s, np.log10(M_ZAMS)]]))
+
+    The predict() method accepts the batch_size and verbose keywords of keras' Model.predict(), so that
+    a NumpyFFNN instance can be passed wherever the routines of stellar_evolution_emulator expect the ffNN.
+
+    """
+
+    def __init__(self, filename = 'models/ffNN_weights.npz', dtype = 'float32', block_size = 1024):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.block_size = block_size
+        with np.load(filename) as weights:
+            self.layers = []
+            for i, kind in enumerate(weights['kinds']):
+                w0, w1 = weights['w0_%d' % i].astype(self.dtype), weights['w1_%d' % i].astype(self.dtype)
+                self.layers.append((str(kind), str(weights['activations'][i]), self.dtype.type(weights['epsilons'][i]), w0, w1))
+
+    def _forward(self, x):
+        for kind, activation, epsilon, w0, w1 in self.layers:
+            if kind == 'Dense':
+                x = x @ w0
+                x += w1
+                x = ffNN_activations[activation](x)
+            else:
+                # LayerNormalization over the feature axis, evaluated as in keras
+                mean = x.mean(axis = -1, keepdims = True)
+                x -= mean
+                x /= np.sqrt(np.square(x).mean(axis = -1, keepdims = True) + epsilon)
+                x *= w0
+                x += w1
+        return x
+
+    def predict(self, X, batch_size = 65536, verbose = 0):
+        X = np.asarray(X, dtype = self.dtype)
+        X = X.reshape(-1, X.shape[-1])
+        n_out = self.layers[-1][3].shape[1]
+        output = np.empty((len(X), n_out), dtype = self.dtype)
+        # the hidden activations of at most block_size rows are held at a time (cache-sized blocks are
+        # faster than a single large matrix product); batch_size only ever lowers the block size
+        batch_size = self.block_size if batch_size is None else max(min(int(batch_size), self.block_size), 1)
+        for start in range(0, len(X), batch_size):
+            output[start:start+batch_size] = self._forward(X[start:start+batch_size])
+        return output
+
+    def __call__(self, X):
+        return self.predict(X)
+
+####################################################################################################
+############################### Lookup tables of the ZAMS/TACHeB age GPRs ##########################
+####################################################################################################
+
+# ZAMS mass range of the fitted models, in log10 of solar masses
+log_M_ZAMS_range = (np.log10(0.7), np.log10(300.))
+
+class AgeLookupTable:
+
+    """
+
+    Dense lookup table of a 1-D age model (gpr_modelTA or gpr_modelTE) over log M_ZAMS, evaluated as a monotone
+    piecewise cubic (PCHIP) spline on a uniform grid of knots.
+
+    Args:
+        filename: .npz file written by AgeLookupTable.save().
+        fallback: model (or function returning the model, called on first use) for inputs outside of the tabulated
+                  log M_ZAMS range; without fallback, such inputs give NaN.
+
+    Usage:
+        >> table = AgeLookupTable.from_model(gpr_modelTA, tolerance=1e-4)
+        >> table.save('models/age_table_TA.npz')
+        >> table = AgeLookupTable('models/age_table_TA.npz', fallback=gpr_modelTA)
+        >> log_zams = table.predict(log_M_ZAMS.reshape(-1,1))
+
+    Attributes:
+        knots           Uniform grid of log M_ZAMS values.
+        values          Model predictions at the knots.
+        slopes          PCHIP derivatives at the knots.
+        max_error       Estimated upper bound of the absolute deviation from the model: the maximum deviation on n_test - 1
+                        test points between each pair of knots and on the training inputs of the model, multiplied by
+                        safety_factor (as the sampled maximum slightly underestimates the true one).
+
+    """
+
+    def __init__(self, filename = None, fallback = None, knots = None, values = None, slopes = None, max_error = None):
+        if filename is not None:
+            with np.load(filename) as table:
+                knots, values, slopes, max_error = table['knots'], table['values'], table['slopes'], float(table['max_error'])
+        self.knots, self.values, self.slopes, self.max_error = knots, values, slopes, max_error
+        self.fallback = fallback
+        self._h = (knots[-1] - knots[0])/(len(knots) - 1)
+
+    @classmethod
+    def from_model(cls, model, log_M_min = log_M_ZAMS_range[0], log_M_max = log_M_ZAMS_range[1], tolerance = 1e-4, 
+                   n_knots = 1025, max_knots = 2**17 + 1, n_test = 32, safety_factor = 1.05):
+        from scipy.interpolate import PchipInterpolator
+        # the number of knots is doubled until the maximum error is within the tolerance (or max_knots is reached)
+        while True:
+            knots = np.linspace(log_M_min, log_M_max, n_knots)
+            values = model.predict(knots.reshape(-1,1))
+            table = cls(knots = knots, values = values, slopes = PchipInterpolator(knots, values).derivative()(knots))
+            test_points = (knots[:-1,np.newaxis] + np.diff(knots)[:,np.newaxis]*np.arange(1, n_test)/n_test).ravel()
+            # and the training inputs of the GPR (where the Matern kernels are least smooth)
+            X_train = np.ravel(getattr(model, 'X_train_', []))
+            test_points = np.concatenate([test_points, X_train[(X_train >= log_M_min) & (X_train <= log_M_max)]])
+            # (the model is evaluated in chunks, which bounds the size of the GPR kernel matrices)
+            table.max_error = safety_factor*max(float(np.max(np.abs(table.predict(chunk) - model.predict(chunk.reshape(-1,1)))))
+                                                for chunk in np.array_split(test_points, -(-len(test_points) // 65536)))
+            if (table.max_error <= tolerance) or (2*n_knots - 1 > max_knots):
+                return table
+            n_knots = 2*n_knots - 1
+
+    def save(self, filename):
+        np.savez(filename, knots = self.knots, values = self.values, slopes = self.slopes, max_error = self.max_error)
+
+    def predict(self, X):
+        x = np.asarray(X, dtype = 'float64').reshape(-1)
+        # interval index & position within the interval, on the uniform grid of knots
+        position = (x - self.knots[0])/self._h
+        i = np.clip(np.floor(position).astype('int64'), 0, len(self.knots) - 2)
+        t = position - i
+        # cubic Hermite basis
+        t2, t3 = t*t, t*t*t
+        y = ((2*t3 - 3*t2 + 1)*self.values[i] + (t3 - 2*t2 + t)*self._h*self.slopes[i] 
+             + (-2*t3 + 3*t2)*self.values[i+1] + (t3 - t2)*self._h*self.slopes[i+1])
+        
+        outside = (x < self.knots[0]) | (x > self.knots[-1])
+        if np.any(outside):
+            if self.fallback is None:
+                y[outside] = np.nan
+            else:
+                if not hasattr(self.fallback, 'predict'):
+                    self.fallback = self.fallback()
+                y[outside] = self.fallback.predict(x[outside].reshape(-1,1))
+        return y
+
+# builds the lookup tables of both age models and saves them next to the other fitted models
+def build_age_tables(gpr_modelTA, gpr_modelTE, models_path = 'models', tolerance = 1e-4):
+    tables = {}
+    for name, model in [('TA', gpr_modelTA), ('TE', gpr_modelTE)]:
+        tables[name] = AgeLookupTable.from_model(model, tolerance = tolerance)
+        tables[name].save(models_path + '/age_table_' + name + '.npz')
+    return tables
+
+####################################################################################################
+################################### KD-tree backend of the KNN model ###############################
+####################################################################################################
+
+class KDTreeKNN:
+
+    """
+
+    Distance-weighted nearest-neighbor regression of s on (t_scaled, log M_ZAMS), with the training data of the
+    fitted knn_model, evaluated with a scipy KD-tree and parallel queries. Gives the same predictions as the
+    scikit-learn model (weights='distance' or 'uniform', euclidean metric), without unpickling it.
+
+    Args:
+        filename: .npz file written by KDTreeKNN.save().
+        leafsize: leaf size of the KD-tree.
+        workers: number of threads of the neighbor queries (-1: all cores).
+
+    Usage:
+        >> KDTreeKNN.from_sklearn(knn_model).save('models/knn_data.npz')
+        >> knn_model = KDTreeKNN('models/knn_data.npz')
+        >> s_pred = knn_model.predict(np.column_stack([t_scaled, log_M_ZAMS]))
+
+    """
+
+    def __init__(self, filename = None, leafsize = 32, workers = -1, fit_X = None, fit_y = None, n_neighbors = None, weights = None):
+        from scipy.spatial import cKDTree
+        if filename is not None:
+            with np.load(filename) as knn_data:
+                fit_X, fit_y, n_neighbors, weights = knn_data['fit_X'], knn_data['fit_y'], int(knn_data['n_neighbors']), str(knn_data['weights'])
+        if weights not in ['distance', 'uniform']:
+            raise ValueError('unsupported weights: ' + str(weights))
+        self.fit_X, self.fit_y, self.n_neighbors, self.weights = fit_X, fit_y, n_neighbors, weights
+        self.workers = workers
+        self.tree = cKDTree(fit_X, leafsize = leafsize)
+
+    @classmethod
+    def from_sklearn(cls, knn_model, leafsize = 32, workers = -1):
+        if knn_model.effective_metric_ != 'euclidean':
+            raise ValueError('unsupported metric: ' + str(knn_model.effective_metric_))
+        return cls(leafsize = leafsize, workers = workers, fit_X = knn_model._fit_X, fit_y = knn_model._y, 
+                   n_neighbors = knn_model.n_neighbors, weights = knn_model.weights)
+
+    def save(self, filename):
+        np.savez(filename, fit_X = self.fit_X, fit_y = self.fit_y, n_neighbors = self.n_neighbors, weights = self.weights)
+
+    def predict(self, X):
+        X = np.asarray(X, dtype = 'float64').reshape(-1, self.fit_X.shape[1])
+        neigh_dist, neigh_ind = self.tree.query(X, k = self.n_neighbors, workers = self.workers)
+        neigh_dist, neigh_ind = neigh_dist.reshape(len(X), -1), neigh_ind.reshape(len(X), -1)
+        fit_y = self.fit_y.reshape(len(self.fit_y), -1)
+        if self.weights == 'uniform':
+            y_pred = np.mean(fit_y[neigh_ind], axis = 1)
+        else:
+            # inverse-distance weights; exact matches of training points get all the weight (as in scikit-learn)
+            with np.errstate(divide = 'ignore'):
+                weights = 1./neigh_dist
+            inf_mask = np.isinf(weights)
+            inf_row = np.any(inf_mask, axis = 1)
+            weights[inf_row] = inf_mask[inf_row]
+            y_pred = np.sum(fit_y[neigh_ind]*weights[:,:,np.newaxis], axis = 1)/np.sum(weights, axis = 1)[:,np.newaxis]
+        return y_pred.ravel() if self.fit_y.ndim == 1 else y_pred
+
+if __name__ == '__main__':
+    import pickle
+    # builds models/age_table_TA.npz and models/age_table_TE.npz from the GPR models
+    tables = build_age_tables(pickle.load(open('models/gpr_modelTA.pkl', 'rb')), pickle.load(open('models/gpr_modelTE.pkl', 'rb')))
+    for name in tables:
+        print('age_table_' + name + ':', len(tables[name].knots), 'knots, maximum error', tables[name].max_error)
+    
+    # stores the training data of the knn model in models/knn_data.npz
+    KDTreeKNN.from_sklearn(pickle.load(open('models/knn_model.pkl', 'rb'))).save('models/knn_data.npz')
+    
+    # exports the SavedModel in models/ffNN to models/ffNN_weights.npz
+    from tensorflow import keras
+    export_ffNN_weights(keras.models.load_model('models/ffNN'))
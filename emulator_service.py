@@ -0,0 +1,212 @@
+import json
+import os
+import queue
+import socket
+import socketserver
+import stat
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from stellar_evolution_emulator import observables_fixed_tau_MZAMS
+
+####################################################################################################
+###################################### Micro-batching predictor ####################################
+####################################################################################################
+
+class BatchingPredictor:
+
+    """
+
+    Thread-safe front end of observables_fixed_tau_MZAMS for many concurrent callers (e.g. MCMC chains running in
+    threads) that each ask for a few (age, ZAMS mass) points at a time. The requests are collected by a single worker
+    thread over a short time window (or until max_batch_size points are pending) and evaluated as one batch through
+    the GPR/KNN/ffNN chain; each caller then receives its own rows of the result.
+
+    Args:
+        emulator: Emulator instance (see stellar_evolution_emulator.py), whose models are loaded before the worker starts.
+        max_batch_size: maximum number of points evaluated in one batch.
+        max_wait: time in seconds the worker waits for further requests after the first request of a batch.
+
+    Usage:
+        >> with BatchingPredictor(Emulator('models')) as predictor:
+        >>     logL_logTeff_logg = predictor.predict(1e7, np.log10(10.))    # from any number of threads
+        >>     future = predictor.submit(ages, log_M_ZAMS)                  # non-blocking
+        >> predictor.batches, predictor.points
+
+    Attributes:
+        batches         Number of batches evaluated so far.
+        points          Number of points evaluated so far.
+
+    """
+
+    def __init__(self, emulator, max_batch_size = 4096, max_wait = 0.002):
+        self.emulator = emulator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches, self.points = 0, 0
+        self._requests = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        emulator.load_all()
+        self._worker = threading.Thread(target = self._run, name = 'BatchingPredictor', daemon = True)
+        self._worker.start()
+
+    # future of the (number of points, 3) observables of the given ages and log ZAMS masses (scalars or arrays)
+    def submit(self, test_age, log_M_ZAMS):
+        test_age, log_M_ZAMS = np.broadcast_arrays(np.asarray(test_age, dtype = 'float64').ravel(), np.asarray(log_M_ZAMS, dtype = 'float64').ravel())
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('the predictor is closed')
+            self._requests.put((test_age, log_M_ZAMS, future))
+        return future
+
+    # blocking version of submit(); for scalar inputs, the result has shape (1, 3) as for observables_fixed_tau_MZAMS
+    def predict(self, test_age, log_M_ZAMS, timeout = None):
+        return self.submit(test_age, log_M_ZAMS).result(timeout)
+
+    # evaluates the pending requests and stops the worker thread
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._requests.put(None)
+        self._worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    # collects the requests of the next batch: blocks for the first one, then waits at most max_wait for further ones
+    def _next_batch(self):
+        request = self._requests.get()
+        if request is None:
+            return [], True
+        batch, n_points = [request], len(request[0])
+        deadline = time.perf_counter() + self.max_wait
+        while n_points < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self._requests.get(timeout = timeout) if timeout > 0 else self._requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            batch.append(request)
+            n_points += len(request[0])
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._next_batch()
+            # requests cancelled by their callers in the meantime are dropped
+            batch = [request for request in batch if request[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                observables = observables_fixed_tau_MZAMS(np.concatenate([request[0] for request in batch]),
+                                                          np.concatenate([request[1] for request in batch]),
+                                                          self.emulator.age_modelTA, self.emulator.age_modelTE,
+                                                          self.emulator.knn_model, self.emulator.ffNN)
+                observables = np.asarray(observables, dtype = 'float64').reshape(-1, 3)
+            except Exception as error:
+                for request in batch:
+                    request[2].set_exception(error)
+                continue
+            self.batches += 1
+            self.points += len(observables)
+            stops = np.cumsum([len(request[0]) for request in batch])
+            for request, rows in zip(batch, np.split(observables, stops[:-1])):
+                request[2].set_result(rows)
+
+####################################################################################################
+######################################### Local socket service #####################################
+####################################################################################################
+
+# The socket protocol is line-delimited JSON: a request {"test_age": ..., "log_M_ZAMS": ...} (numbers or lists)
+# is answered by {"observables": [[logL, logTeff, logg], ...]}, or by {"error": message}.
+
+class _PredictionHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                observables = self.server.predictor.predict(request['test_age'], request['log_M_ZAMS'])
+                response = {'observables': observables.tolist()}
+            except Exception as error:
+                response = {'error': '%s: %s' % (type(error).__name__, error)}
+            self.wfile.write((json.dumps(response) + '\n').encode())
+            self.wfile.flush()
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class _ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+# socket server of a BatchingPredictor, on a Unix socket (address given as a path) or on a TCP socket (address given
+# as a (host, port) tuple, use a local host only); each connection is handled in its own thread, so that the requests
+# of concurrent clients are batched together. The server runs in a background thread; call shutdown() to stop it
+def serve(predictor, address):
+    if isinstance(address, str):
+        # a stale socket of a former server is replaced, any other file is left alone
+        if os.path.exists(address):
+            if not stat.S_ISSOCK(os.stat(address).st_mode):
+                raise FileExistsError(address + ' exists and is not a socket')
+            os.remove(address)
+        server = _ThreadingUnixServer(address, _PredictionHandler)
+    else:
+        server = _ThreadingTCPServer(tuple(address), _PredictionHandler)
+    server.predictor = predictor
+    threading.Thread(target = server.serve_forever, name = 'PredictionServer', daemon = True).start()
+    return server
+
+class PredictionClient:
+
+    """
+
+    Client of a prediction server started with serve(), over a single connection (use one client per thread).
+
+    Usage:
+        >> client = PredictionClient('/tmp/emulator.sock')
+        >> logL_logTeff_logg = client.predict(1e7, np.log10(10.))
+
+    """
+
+    def __init__(self, address, timeout = None):
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self._socket = socket.socket(family, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(address if isinstance(address, str) else tuple(address))
+        self._file = self._socket.makefile('rwb')
+
+    def predict(self, test_age, log_M_ZAMS):
+        request = {'test_age': np.asarray(test_age, dtype = 'float64').tolist(), 'log_M_ZAMS': np.asarray(log_M_ZAMS, dtype = 'float64').tolist()}
+        self._file.write((json.dumps(request) + '\n').encode())
+        self._file.flush()
+        response = json.loads(self._file.readline())
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return np.array(response['observables'], dtype = 'float64').reshape(-1, 3)
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
@@ -0,0 +1,103 @@
+import time
+from contextlib import contextmanager
+
+####################################################################################################
+###################################### Stage-level timing counters #################################
+####################################################################################################
+
+class StageStats:
+
+    """
+
+    Opt-in call counts, batch sizes and cumulative wall times per stage of the emulator and HNNI pipelines
+    (stages 'age_models', 'knn', 'ffNN', 'dataframes' in stellar_evolution_emulator.py and 'HNNI_mass_neighbors',
+    'HNNI_s_brackets', 'HNNI_s_interpolation', 'HNNI_mass_interpolation', 'HNNI_grid_neighbors' in HNNI_routines.py).
+
+    Usage:
+        >> with profile_stages() as stats:
+        >>     iso_dict, all_columns_df = isochrone_computation(log_Mini, iso_values, ...)
+        >> print(stats.report())
+        >> stats.summary()['ffNN']['seconds']
+
+    While disabled (the default), stage() returns a shared no-op context manager, so that the instrumented
+    routines only pay for a method call per stage.
+
+    Attributes:
+        enabled         Whether stages are being recorded.
+        calls           Dictionary containing the number of calls per stage.
+        items           Dictionary containing the total number of items (stars, queries, ...) per stage.
+        seconds         Dictionary containing the cumulative wall time in seconds per stage.
+
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.calls, self.items, self.seconds = {}, {}, {}
+
+    def record(self, name, n_items, seconds):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.items[name] = self.items.get(name, 0) + n_items
+        self.seconds[name] = self.seconds.get(name, 0.) + seconds
+
+    def stage(self, name, n_items = 0):
+        if not self.enabled:
+            return _no_stage
+        return _TimedStage(self, name, n_items)
+
+    def summary(self):
+        return {name: {'calls': self.calls[name], 'items': self.items[name], 'seconds': self.seconds[name],
+                       'mean_batch_size': self.items[name]/self.calls[name], 'seconds_per_call': self.seconds[name]/self.calls[name]}
+                for name in self.calls}
+
+    def report(self):
+        total = sum(self.seconds.values())
+        lines = ['%-26s %10s %14s %12s %8s' % ('stage', 'calls', 'mean batch', 'seconds', 'share')]
+        for name in sorted(self.seconds, key = self.seconds.get, reverse = True):
+            lines.append('%-26s %10d %14.1f %12.4f %7.1f%%' % (name, self.calls[name], self.items[name]/self.calls[name],
+                                                                self.seconds[name], 100*self.seconds[name]/total if total > 0 else 0.))
+        return '\n'.join(lines)
+
+class _TimedStage:
+
+    __slots__ = ('stats', 'name', 'n_items', 'start')
+
+    def __init__(self, stats, name, n_items):
+        self.stats, self.name, self.n_items = stats, name, n_items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.record(self.name, self.n_items, time.perf_counter() - self.start)
+        return False
+
+class _NoStage:
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_no_stage = _NoStage()
+
+# global statistics of the instrumented routines
+stage_stats = StageStats()
+
+# records the stages within the with-block (resetting the counters first, unless reset=False)
+@contextmanager
+def profile_stages(stats = stage_stats, reset = True):
+    previously_enabled = stats.enabled
+    if reset:
+        stats.reset()
+    stats.enabled = True
+    try:
+        yield stats
+    finally:
+        stats.enabled = previously_enabled
@@ -1,3 +1,6 @@
+import os
+import json
+import hashlib
 import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
@@ -29,79 +32,199 @@ def mist_dataframe(eeps, basic_columns):
         basic_df[basic_column] = eeps[basic_column]
     return basic_df
 
-def phases_cutWR(basic_df, phases_list, M0):    
+# cuts of the late WR / core-helium depleted rows, applied after the phase selection (MIST catalog thresholds):
+# each rule (M0_min, M0_max, phases, center_he4_min) removes, for tracks with M0_min <= M0 <= M0_max, the rows 
+# with center_he4 <= center_he4_min that are in the given phases (None: in any phase); only the first matching rule applies
+MIST_cut_policy = [(60, 110, [9], 1e-4), 
+                   (115, np.inf, None, 1e-4)]
+
+def phases_cutWR(basic_df, phases_list, M0, cut_policy=MIST_cut_policy):    
 
     # selection of evolutionary sequences from ZAMS up to TACHeB, incl. WR phase
-    for i in range(0, len(basic_df)):
-        if basic_df.loc[i,'phase'] not in phases_list:
-            basic_df = basic_df.drop(index=i)
-    basic_df.reset_index(drop=True, inplace= True)
-    if (M0 <= 110) and (M0 >= 60):
-        for i in range(0, len(basic_df)):
-            if (basic_df.loc[i, 'phase'] == 9) and (basic_df.loc[i, 'center_he4'] <= 1e-4):
-                basic_df = basic_df.drop(index=i)
-        basic_df.reset_index(drop=True, inplace= True)
-    elif (M0 >=115):
-        for i in range(0, len(basic_df)):
-            if (basic_df.loc[i, 'center_he4'] <= 1e-4):
-                basic_df = basic_df.drop(index=i)
-        basic_df.reset_index(drop=True, inplace= True)
-    return basic_df
+    phase = basic_df['phase'].to_numpy()
+    keep = np.isin(phase, phases_list)
+    for M0_min, M0_max, phases, center_he4_min in cut_policy:
+        if (M0 >= M0_min) and (M0 <= M0_max):
+            cut = basic_df['center_he4'].to_numpy() <= center_he4_min
+            if phases is not None:
+                cut &= np.isin(phase, phases)
+            keep &= ~cut
+            break
+    return basic_df[keep].reset_index(drop=True)
+
+# cumulative path length along a track in the space spanned by the given axes (e.g. log_L, log_Teff, log_center_Rho),
+# starting at zero; each axis holds the values of a single track (1-D) or of a stack of tracks (2-D, one track per row),
+# and the optional weights scale the steps along each axis. Tracks of different lengths can be stacked with trailing 
+# NaN padding, for which the path length is NaN.
+def path_length(*axes, weights=None):
+    axes = [np.asarray(axis_values, dtype='float64') for axis_values in axes]
+    steps = [np.diff(axis_values, axis=-1) for axis_values in axes]
+    if weights is not None:
+        steps = [weight*step for weight, step in zip(weights, steps)]
+    
+    # euclidean step lengths, summed up along the track
+    squared_steps = steps[0]**2
+    for step in steps[1:]:
+        squared_steps = squared_steps + step**2
+    step_lengths = np.sqrt(squared_steps)
+    padding = np.isnan(step_lengths)
+    step_lengths[padding] = 0.
+    
+    path_lengths = np.zeros(axes[0].shape)
+    np.cumsum(step_lengths, axis=-1, out=path_lengths[..., 1:])
+    path_lengths[np.isnan(sum(axes))] = np.nan
+    return path_lengths
+
+# path length along a track normalized to the range [0, 1], see path_length
+def s_coordinate(*axes, weights=None):
+    path_lengths = path_length(*axes, weights=weights)
+    return path_lengths/np.nanmax(path_lengths, axis=-1, keepdims=True)
 
 # method to calculate the timescale-adapted evolutionary coordinate s
 def Axes3_proxy(L, T, nuc):
-    delta_c = 0
-    path_length_list = [delta_c]    
-    for i in range(0, len(L)-1):
-        lumi, lumj = L[i], L[i+1]
-        tempi, tempj = T[i], T[i+1]
-        nuci, nucj = nuc[i], nuc[i+1]
-        delta_l = abs(lumj-lumi)
-        delta_T = abs(tempj-tempi)
-        delta_nuc = abs(nuci-nucj)
-        delta_c = delta_c + np.sqrt(delta_l**2+delta_T**2+delta_nuc**2)
-        path_length_list.append(delta_c)  
-    return path_length_list
-
-def MIST_data_reader(initial_masses, dict1, new_path, phases_list, basic_columns):
-
-    multiple_masses_df = dict()
-
-    # file names
-    for i in range(0, len(initial_masses)):
-        # find file name for given initial mass input
-        initial_mass = initial_masses[i]
-        filename = dict1[initial_mass]    
-    
-        # load eep track
-        eep = eep_read1.EEP(new_path+'/'+ filename + '.track.eep')
-        #print(eep)
-    
-        # store the chosen data columns
-        basic_df = mist_dataframe(eep.eeps, basic_columns)
-        #print(basic_df)
-        
-        # cut out pre-main sequence, agb and post-agb phases
-        basic_df = phases_cutWR(basic_df, phases_list, initial_mass)
-        #print(basic_df)
-        
-        # calculate s
-        path_length_list = Axes3_proxy(basic_df['log_L'], basic_df['log_Teff'], basic_df['log_center_Rho'])
-        basic_df['s_tilde'] = path_length_list
-        basic_df['s'] = path_length_list/path_length_list[-1] 
-
-        # store in df
-        multiple_masses_df[initial_mass] = basic_df
-        #print(multiple_masses_df)
-    return multiple_masses_df
-
-
-
-
-
+    return path_length(L, T, nuc)
 
+# reading in and processing a single track: data columns, phase cuts and s
+def MIST_track_reader(eep_filename, initial_mass, phases_list, basic_columns, cache=False, cut_policy=MIST_cut_policy):
+    
+    # load eep track
+    eep = eep_read1.EEP(eep_filename, columns=basic_columns, cache=cache)
+    #print(eep)
 
+    # store the chosen data columns
+    basic_df = mist_dataframe(eep.eeps, basic_columns)
+    #print(basic_df)
+    
+    # cut out pre-main sequence, agb and post-agb phases
+    basic_df = phases_cutWR(basic_df, phases_list, initial_mass, cut_policy)
+    #print(basic_df)
+    
+    # calculate s
+    path_length_list = Axes3_proxy(basic_df['log_L'], basic_df['log_Teff'], basic_df['log_center_Rho'])
+    basic_df['s_tilde'] = path_length_list
+    basic_df['s'] = path_length_list/path_length_list[-1] 
+    return basic_df
 
+# reading in, processing and storing the tracks of the given initial masses;
+# with cache=True, the parsed EEP files are cached in binary .npz files next to the .track.eep files;
+# with n_jobs > 1 (or n_jobs=None for all cores), the tracks are processed in parallel by a pool of n_jobs processes;
+# progress, if given, is called as progress(number of tracks done, number of tracks, initial mass) after each track;
+# cut_policy holds the WR / center_he4 cut rules of phases_cutWR
+def MIST_data_reader(initial_masses, dict1, new_path, phases_list, basic_columns, cache=False, n_jobs=1, progress=None, 
+                     cut_policy=MIST_cut_policy):
 
+    multiple_masses_df = dict()
 
+    # file names: find file name for given initial mass input
+    eep_filenames = [new_path+'/'+ dict1[initial_mass] + '.track.eep' for initial_mass in initial_masses]
+    
+    if n_jobs == 1:
+        for i in range(0, len(initial_masses)):
+            initial_mass = initial_masses[i]
+            multiple_masses_df[initial_mass] = MIST_track_reader(eep_filenames[i], initial_mass, phases_list, basic_columns, cache, cut_policy)
+            if progress is not None:
+                progress(i+1, len(initial_masses), initial_mass)
+        return multiple_masses_df
+    
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    processed = {}
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = {pool.submit(MIST_track_reader, eep_filenames[i], initial_masses[i], phases_list, basic_columns, cache, cut_policy): i 
+                   for i in range(0, len(initial_masses))}
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            i = futures[future]
+            processed[i] = future.result()
+            if progress is not None:
+                progress(n_done, len(initial_masses), initial_masses[i])
+    
+    # store in df, in the order of the initial masses
+    for i in range(0, len(initial_masses)):
+        multiple_masses_df[initial_masses[i]] = processed[i]
+    return multiple_masses_df
 
+# incremental version of MIST_data_reader with a persistent catalog in the catalog_path directory: the processed tracks
+# are stored there (one .npz file per track) together with a manifest.json of the source .track.eep files (path, 
+# modification time and size) and of the processing parameters (phases_list, basic_columns, cut_policy and further 
+# options such as {'CHeB_augmentation': False}). Only the tracks that are new, whose source files changed, or that 
+# were processed with other parameters are read in again; the others are loaded from the catalog directory.
+# The tracks are added to (or replaced in) catalog_data in place, if given, and to catalog_index (a CatalogIndex built 
+# from catalog_data) in place with CatalogIndex.update(); returns catalog_data and the list of re-processed masses
+def MIST_catalog_update(catalog_path, initial_masses, dict1, new_path, phases_list, basic_columns, catalog_data=None, 
+                        catalog_index=None, cache=False, n_jobs=1, progress=None, cut_policy=MIST_cut_policy, options=None):
+    
+    catalog_data = dict() if catalog_data is None else catalog_data
+    os.makedirs(os.path.join(catalog_path, 'tracks'), exist_ok=True)
+    manifest_filename = os.path.join(catalog_path, 'manifest.json')
+    parameters = json.loads(json.dumps({'phases_list': list(phases_list), 'basic_columns': list(basic_columns), 
+                                        'cut_policy': cut_policy, 'options': options or {}}, default=str))
+    try:
+        with open(manifest_filename) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {'tracks': {}}
+    
+    # stale tracks: not in the manifest, or with changed source file or processing parameters
+    stale_masses, sources = [], dict()
+    for initial_mass in initial_masses:
+        eep_filename = os.path.abspath(new_path + '/' + dict1[initial_mass] + '.track.eep')
+        stat = os.stat(eep_filename)
+        source = {'initial_mass': float(initial_mass), 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'parameters': parameters,
+                  'track_file': hashlib.sha1(eep_filename.encode()).hexdigest() + '.npz'}
+        sources[initial_mass] = (eep_filename, source)
+        if (manifest['tracks'].get(eep_filename) != source) or not os.path.exists(os.path.join(catalog_path, 'tracks', source['track_file'])):
+            stale_masses.append(initial_mass)
+    
+    processed = MIST_data_reader(stale_masses, dict1, new_path, phases_list, basic_columns, cache, n_jobs, progress, cut_policy) if stale_masses else dict()
+    for initial_mass, basic_df in processed.items():
+        eep_filename, source = sources[initial_mass]
+        track_filename = os.path.join(catalog_path, 'tracks', source['track_file'])
+        with open(track_filename + '.tmp', 'wb') as f:
+            np.savez(f, columns=np.array(list(basic_df.columns)), **{'column:' + name: basic_df[name].to_numpy() for name in basic_df.columns})
+        os.replace(track_filename + '.tmp', track_filename)
+        manifest['tracks'][eep_filename] = source
+    if processed:
+        with open(manifest_filename + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_filename + '.tmp', manifest_filename)
+    
+    # tracks of the catalog directory, for the masses that are not in catalog_data yet
+    added = dict(processed)
+    for initial_mass in initial_masses:
+        if initial_mass not in processed and initial_mass not in catalog_data:
+            with np.load(os.path.join(catalog_path, 'tracks', sources[initial_mass][1]['track_file'])) as track:
+                added[initial_mass] = pd.DataFrame({str(name): track['column:' + str(name)] for name in track['columns']})
+    catalog_data.update(added)
+    
+    # all tracks added to or replaced in catalog_data, also in catalog_index
+    if catalog_index is not None and added:
+        catalog_index.update(added)
+    return catalog_data, stale_masses
+
+# reading in several catalog grids at once: the .track.eep files in the given directories (or the given files) are 
+# grouped into grids by their ([Fe/H], v/vcrit) header values, and the tracks of each grid are read with MIST_data_reader
+# under their initial mass; returns a dictionary of grid keys ([Fe/H], v/vcrit) and catalog_data dictionaries
+def MIST_grid_reader(paths, phases_list, basic_columns, cache=False, n_jobs=1, progress=None, cut_policy=MIST_cut_policy):
+    
+    paths = [paths] if isinstance(paths, str) else list(paths)
+    eep_filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            eep_filenames += [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.track.eep')]
+        else:
+            eep_filenames.append(path)
+    
+    # grid key and initial mass of each track, from the EEP headers only
+    groups = dict()
+    for eep_filename in eep_filenames:
+        version, abun, rot, minit, hdr_list = eep_read1.read_eep_header(eep_filename)
+        directory, name = os.path.split(eep_filename)
+        directory = directory or '.'
+        groups.setdefault(((abun['[Fe/H]'], rot), directory), dict())[minit] = name[:-len('.track.eep')]
+    
+    grids = dict()
+    for (key, directory), dict1 in groups.items():
+        catalog_data = MIST_data_reader(sorted(dict1.keys()), dict1, directory, phases_list, basic_columns, cache, n_jobs, progress, cut_policy)
+        grids.setdefault(key, dict()).update(catalog_data)
+    
+    # tracks of each grid in the order of their initial masses
+    return {key: {mass: grids[key][mass] for mass in sorted(grids[key])} for key in sorted(grids)}
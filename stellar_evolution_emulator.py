@@ -1,17 +1,18 @@
 #!/usr/bin/env python
 
 import numpy as np
-from tensorflow import keras 
-#from tensorflow.keras.models import load_model
-import tensorflow 
-import pandas as pd
 import pickle
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-import matplotlib
+import time
+import os
+from pipeline_stats import stage_stats, profile_stages
+
+# tensorflow/keras, pandas and matplotlib are imported where they are needed, so that importing this module 
+# (e.g. for observables_fixed_tau_MZAMS with the NumPy ffNN backend) stays cheap
 
 # color map for discriminating stellar evolution tracks in the HR and Kiel diagram
 def color_map_color(value, cmap_name='Wistia', vmin=0, vmax=1):
+    import matplotlib
+    import matplotlib.cm as cm
     # norm = plt.Normalize(vmin, vmax)
     norm = matplotlib.colors.Normalize(vmin=vmin, vmax=vmax)
     cmap = cm.get_cmap(cmap_name)  # PiYG
@@ -19,16 +20,86 @@ def color_map_color(value, cmap_name='Wistia', vmin=0, vmax=1):
     color = matplotlib.colors.rgb2hex(rgb)
     return color
 
-# predicting stellar observables with the ffNN model
+# predicting stellar observables with the ffNN model, for many tracks in a single forward pass:
+# M_ZAMS holds n_tracks ZAMS masses, s_sampling is either shared by all tracks (n_s,) or given per track (n_tracks, n_s);
+# returns a contiguous (n_tracks, n_s, 3) array of logL, logTeff and logg
+def HR_and_Kiel_tracks(M_ZAMS, s_sampling, ffNN, batch_size = 65536):
+    log_M = np.log10(np.asarray(M_ZAMS, dtype = 'float64')).ravel()
+    s_grid = np.broadcast_to(np.asarray(s_sampling, dtype = 'float64'), (len(log_M), np.shape(s_sampling)[-1]))
+
+    # (s, log M_ZAMS) input pairs of all tracks, one row per track point
+    X = np.empty((s_grid.size, 2))
+    X[:,0] = s_grid.ravel()
+    X[:,1] = np.repeat(log_M, s_grid.shape[1])
+
+    with stage_stats.stage('ffNN', len(X)):
+        output_nn = np.asarray(ffNN.predict(X, batch_size = batch_size), dtype = 'float64')
+    return np.ascontiguousarray(output_nn.reshape(s_grid.shape[0], s_grid.shape[1], 3))
+
+# predicting stellar observables with the ffNN model, for a single track
 def HR_and_Kiel_track(M_ZAMS, s_sampling, ffNN):
-    L_vals, Teff_vals, g_vals = [], [], []
-    for s in s_sampling:
-        logL_logTeff_logg_s = ffNN.predict(np.array([s, np.log10(M_ZAMS)]).reshape(1,-1))
-        L_vals.append(logL_logTeff_logg_s[:,0]), Teff_vals.append(logL_logTeff_logg_s[:,1]), g_vals.append(logL_logTeff_logg_s[:,2])
+    track = HR_and_Kiel_tracks([M_ZAMS], s_sampling, ffNN)[0]
+    L_vals, Teff_vals, g_vals = track[:,0], track[:,1], track[:,2]
     return L_vals, Teff_vals, g_vals
 
+# adaptive sampling of the evolutionary coordinate s for the tracks of the given ZAMS masses: starting from n_initial
+# uniformly spaced s values, each refinement round inserts the midpoints of the intervals whose step in the weighted 
+# (logL, logTeff, logg) space exceeds tol, or which adjoin a point where the track turns by more than angle_tol 
+# (in radians) between two steps of at least bend_fraction*tol (so that bends below the target resolution, e.g. the
+# noise of the ffNN on tiny steps, are not resolved), with a single batched ffNN call for the new points of all tracks;
+# intervals narrower than min_ds are not refined further. 
+# Returns, per track, the ascending s values and the (n_s, 3) array of logL, logTeff and logg
+def HR_and_Kiel_tracks_adaptive(M_ZAMS, ffNN, tol = 0.02, angle_tol = 0.2, bend_fraction = 0.5, n_initial = 33, max_rounds = 12, 
+                                min_ds = 1e-4, weights = (1., 1., 1.), s_range = (0., 1.), batch_size = 65536):
+    log_M = np.log10(np.asarray(M_ZAMS, dtype = 'float64')).ravel()
+    weights = np.asarray(weights, dtype = 'float64')
+    
+    # (track id, s) of all points so far, and their observables
+    track_ids = np.repeat(np.arange(len(log_M)), n_initial)
+    s_values = np.tile(np.linspace(s_range[0], s_range[1], n_initial), len(log_M))
+    new_track_ids, new_s = track_ids, s_values
+    observables = np.empty((0, 3))
+    for refinement_round in range(max_rounds + 1):
+        with stage_stats.stage('ffNN', len(new_s)):
+            new_observables = np.asarray(ffNN.predict(np.column_stack([new_s, log_M[new_track_ids]]), batch_size = batch_size), dtype = 'float64')
+        observables = np.concatenate([observables, new_observables])
+        order = np.lexsort((s_values, track_ids))
+        track_ids, s_values, observables = track_ids[order], s_values[order], observables[order]
+        if refinement_round == max_rounds:
+            break
+        
+        # steps between consecutive points of the same track
+        same_track = track_ids[1:] == track_ids[:-1]
+        steps = np.diff(observables, axis = 0)*weights
+        step_lengths = np.sqrt(np.sum(steps**2, axis = 1))
+        refine = step_lengths > tol
+        
+        # turning angles at the interior points of each track, flagging the intervals on both sides
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            cos_angle = np.sum(steps[1:]*steps[:-1], axis = 1)/(step_lengths[1:]*step_lengths[:-1])
+        long_steps = step_lengths >= bend_fraction*tol
+        bend = same_track[1:] & same_track[:-1] & long_steps[1:] & long_steps[:-1] & (cos_angle < np.cos(angle_tol))
+        refine[1:] |= bend
+        refine[:-1] |= bend
+        
+        refine &= same_track & (np.diff(s_values) > min_ds)
+        if not np.any(refine):
+            break
+        new_track_ids = track_ids[:-1][refine]
+        new_s = 0.5*(s_values[:-1][refine] + s_values[1:][refine])
+        track_ids, s_values = np.concatenate([track_ids, new_track_ids]), np.concatenate([s_values, new_s])
+    
+    starts = np.searchsorted(track_ids, np.arange(1, len(log_M)))
+    return list(zip(np.split(s_values, starts), np.split(observables, starts)))
+
+# adaptive sampling for a single track (see HR_and_Kiel_tracks_adaptive)
+def HR_and_Kiel_track_adaptive(M_ZAMS, ffNN, **kwargs):
+    s_values, track = HR_and_Kiel_tracks_adaptive([M_ZAMS], ffNN, **kwargs)[0]
+    return s_values, track[:,0], track[:,1], track[:,2]
+
 # plotting routines for the HR and Kiel diagram
 def plot_HR(L_vals, Teff_vals, M_ZAMS):
+    import matplotlib.pyplot as plt
     plt.figure()
     plt.scatter(Teff_vals, L_vals, s = 2.5)
     plt.xlabel(r"$\log T_\mathrm{eff} / K$", fontsize = 14)
@@ -37,6 +108,7 @@ def plot_HR(L_vals, Teff_vals, M_ZAMS):
     plt.title(r"$M_\mathrm{ZAMS}/M_\odot=$"+str(M_ZAMS), fontsize = 14.5)
     plt.show()     
 def plot_Kiel(g_vals, Teff_vals, M_ZAMS):
+    import matplotlib.pyplot as plt
     plt.figure()
     plt.scatter(Teff_vals, g_vals, s = 2.5)
     plt.xlabel(r"$\log T_\mathrm{eff} / \mathrm{K}$", fontsize = 14)
@@ -50,74 +122,373 @@ def t_calc(logt_zams, logt_tacheb, log_t):
     t_tilde = (log_t - logt_zams)/(logt_tacheb - logt_zams)
     return t_tilde
 
-# prediction of the stellar observables at any age and ZAMS mass using the two-step interpolation scheme
+# prediction of the stellar observables at any age and ZAMS mass using the two-step interpolation scheme;
+# test_age and log_M_ZAMS are scalars or arrays (of the same length), the output has shape (number of stars, 3)
 def observables_fixed_tau_MZAMS(test_age, log_M_ZAMS, gpr_modelTA, gpr_modelTE, knn_model, ffNN):
+    test_age, log_M_ZAMS = np.broadcast_arrays(np.asarray(test_age, dtype = 'float64').ravel(), np.asarray(log_M_ZAMS, dtype = 'float64').ravel())
     
     # stellar ages at ZAMS and at the end of CHeB
-    logt_zams = gpr_modelTA.predict(log_M_ZAMS.reshape(1,-1))
-    logt_tacheb = gpr_modelTE.predict(log_M_ZAMS.reshape(1,-1))    
+    with stage_stats.stage('age_models', len(log_M_ZAMS)):
+        logt_zams = gpr_modelTA.predict(log_M_ZAMS.reshape(-1,1))
+        logt_tacheb = gpr_modelTE.predict(log_M_ZAMS.reshape(-1,1))    
     
     # scaled age variable
     t_scaled = t_calc(logt_zams, logt_tacheb, np.log10( test_age ))   
             
     # knn prediction of the timescale-adapted evolutionary coordinate 
-    s_pred = knn_model.predict(np.array([t_scaled, log_M_ZAMS], dtype = 'float64').reshape(1,-1))
+    with stage_stats.stage('knn', len(log_M_ZAMS)):
+        s_pred = knn_model.predict(np.column_stack([t_scaled, log_M_ZAMS])).ravel()
             
     # ffnn prediction of observables
-    output_nn = ffNN.predict(np.array([float(s_pred), log_M_ZAMS]).reshape(1,-1))
+    with stage_stats.stage('ffNN', len(log_M_ZAMS)):
+        output_nn = ffNN.predict(np.column_stack([s_pred, log_M_ZAMS]))
     
     return output_nn
 
-# routine for calculating isochrones in the HR diagram
-def isochrone_computation(log_Mini, iso_values, gpr_modelTA, gpr_modelTE, knn_model, ffNN):
+# prediction of the stellar observables of a population of stars with the given ages and (log) ZAMS masses, 
+# processed in chunks of chunk_size stars to keep the memory footprint of the GPR, KNN and ffNN stages bounded;
+# returns the (number of stars, 3) observables (NaN for stars outside of the ZAMS-TACHeB age window), 
+# the scaled ages t_scaled, and the boolean in_window flags (ZAMS <= age < TACHeB)
+def observables_population(test_ages, log_M_ZAMS, gpr_modelTA, gpr_modelTE, knn_model, ffNN, chunk_size = 32768):
+    test_ages, log_M_ZAMS = np.broadcast_arrays(np.asarray(test_ages, dtype = 'float64').ravel(), np.asarray(log_M_ZAMS, dtype = 'float64').ravel())
+    n_stars = len(test_ages)
+    observables = np.full((n_stars, 3), np.nan)
+    t_scaled = np.empty(n_stars)
+    in_window = np.zeros(n_stars, dtype = bool)
     
-    # Prediction of (log-scaled) stellar age at ZAMS & at TACHeB, for the given ZAMS masses
-    log_zams_mini = gpr_modelTA.predict(log_Mini.reshape(-1,1))
-    log_tacheb_mini = gpr_modelTE.predict(log_Mini.reshape(-1,1))
+    for start in range(0, n_stars, chunk_size):
+        stop = min(start + chunk_size, n_stars)
+        log_M_chunk = log_M_ZAMS[start:stop]
+        
+        # stellar ages at ZAMS and at the end of CHeB, and scaled age variable
+        with stage_stats.stage('age_models', len(log_M_chunk)):
+            logt_zams = gpr_modelTA.predict(log_M_chunk.reshape(-1,1))
+            logt_tacheb = gpr_modelTE.predict(log_M_chunk.reshape(-1,1))
+        t_scaled[start:stop] = t_calc(logt_zams, logt_tacheb, np.log10(test_ages[start:stop]))
+        
+        # only the stars between ZAMS and TACHeB are passed on to the knn & ffnn predictions
+        window = (t_scaled[start:stop] >= 0) & (t_scaled[start:stop] < 1)
+        in_window[start:stop] = window
+        if np.any(window):
+            rows = np.flatnonzero(window) + start
+            with stage_stats.stage('knn', len(rows)):
+                s_pred = knn_model.predict(np.column_stack([t_scaled[rows], log_M_ZAMS[rows]])).ravel()
+            with stage_stats.stage('ffNN', len(rows)):
+                observables[rows] = ffNN.predict(np.column_stack([s_pred, log_M_ZAMS[rows]]), batch_size = chunk_size)
     
-    # data tables to fill    
-    iso_dict = {}
-    all_data_lists = []
+    return observables, t_scaled, in_window
+
+# sampling of (log) ZAMS masses from a power-law initial mass function dN/dM ~ M^-alpha within (M_min, M_max)
+# (alpha = 2.35: Salpeter IMF, alpha = 2.3: Kroupa IMF above 0.5 solar masses)
+def sample_IMF(n_stars, M_min = 0.7, M_max = 300., alpha = 2.35, rng = None):
+    rng = np.random.default_rng(rng)
+    u = rng.uniform(0, 1, n_stars)
+    if alpha == 1:
+        return np.log10(M_min) + u*(np.log10(M_max) - np.log10(M_min))
+    # inverse of the cumulative distribution function
+    a_min, a_max = M_min**(1-alpha), M_max**(1-alpha)
+    return np.log10(a_min + u*(a_max - a_min))/(1-alpha)
 
-    # for each isochrone value, ...
-    for t in iso_values:
+# sampling of stellar ages (in years) within (age_min, age_max), for a star-formation history given as the star-formation 
+# rate SFR(age) as a function of stellar age (i.e. lookback time); constant star formation by default
+def sample_SFH(n_stars, age_min, age_max, SFR = None, rng = None, n_grid = 4096):
+    rng = np.random.default_rng(rng)
+    u = rng.uniform(0, 1, n_stars)
+    if SFR is None:
+        return age_min + u*(age_max - age_min)
+    # inverse of the tabulated cumulative distribution function
+    age_grid = np.linspace(age_min, age_max, n_grid)
+    SFR_grid = np.asarray(SFR(age_grid), dtype = 'float64')
+    cdf = np.concatenate([[0], np.cumsum(0.5*(SFR_grid[1:] + SFR_grid[:-1])*np.diff(age_grid))])
+    return np.interp(u*cdf[-1], cdf, age_grid)
 
-        iso_vals = pd.DataFrame(columns = ["logL", "logT", "logg"])
-        T_vals, L_vals, g_vals = [], [], [] 
+# synthetic stellar population: ages drawn from the star-formation history and ZAMS masses from the IMF, 
+# with observables predicted chunk by chunk (see observables_population)
+def synthetic_population(n_stars, gpr_modelTA, gpr_modelTE, knn_model, ffNN, age_min, age_max, SFR = None, 
+                         M_min = 0.7, M_max = 300., alpha = 2.35, rng = None, chunk_size = 32768):
+    rng = np.random.default_rng(rng)
+    test_ages = sample_SFH(n_stars, age_min, age_max, SFR, rng)
+    log_M_ZAMS = sample_IMF(n_stars, M_min, M_max, alpha, rng)
+    observables, t_scaled, in_window = observables_population(test_ages, log_M_ZAMS, gpr_modelTA, gpr_modelTE, knn_model, ffNN, chunk_size)
+    return test_ages, log_M_ZAMS, observables, in_window
+
+# knn & ffnn predictions for the (isochrone index, ZAMS mass index) pairs age_index, mass_index of an isochrone grid,
+# returning the columns of the integral isochrone data frame (logL, logTeff, logg, logMini, isochrone, test_age, t_scaled)
+def _isochrone_rows(age_index, mass_index, t_values, log_Mini, log_zams_mini, log_tacheb_mini, knn_model, ffNN, batch_size = 65536):
+    log_M_vals = log_Mini[mass_index]
+    log_test_age = np.log10(10.**log_zams_mini[mass_index] + t_values[age_index])
     
-        # ...., calculate for each sampled ZAMS mass ...
-        for i in range(0, len(log_Mini)):
-            log_M_val = log_Mini[i]
-        
-            # 1) ... the ages at ZAMS & at TACHeB 
-            log_zams, log_tacheb = log_zams_mini[i], log_tacheb_mini[i]
+    # scaled age variable calculation
+    t_scaled = t_calc(log_zams_mini[mass_index], log_tacheb_mini[mass_index], log_test_age)
+    
+    # knn prediction of the timescale-adapted evolutionary coordinate & ffnn prediction of observables,
+    # each as a single call over all given (age, mass) pairs
+    output_nn = np.empty((len(log_M_vals), 3))
+    if len(log_M_vals) > 0:
+        with stage_stats.stage('knn', len(log_M_vals)):
+            s_pred = knn_model.predict(np.column_stack([t_scaled, log_M_vals])).ravel()
+        with stage_stats.stage('ffNN', len(log_M_vals)):
+            output_nn[:] = ffNN.predict(np.column_stack([s_pred, log_M_vals]), batch_size = batch_size)
+    
+    return {"logL": output_nn[:,0], "logTeff": output_nn[:,1], "logg": output_nn[:,2], "logMini": log_M_vals, 
+            "isochrone": np.log10(t_values[age_index]), "test_age": log_test_age, "t_scaled": t_scaled}
+
+# routine for calculating isochrones in the HR diagram
+def isochrone_computation(log_Mini, iso_values, gpr_modelTA, gpr_modelTE, knn_model, ffNN, batch_size = 65536):
+    import pandas as pd
+    
+    # Prediction of (log-scaled) stellar age at ZAMS & at TACHeB, for the given ZAMS masses
+    log_Mini = np.asarray(log_Mini, dtype = 'float64').ravel()
+    with stage_stats.stage('age_models', len(log_Mini)):
+        log_zams_mini = gpr_modelTA.predict(log_Mini.reshape(-1,1))
+        log_tacheb_mini = gpr_modelTE.predict(log_Mini.reshape(-1,1))
+    
+    # time past the ZAMS age on the whole (isochrone values x ZAMS masses) grid
+    t_values = np.asarray(iso_values, dtype = 'float64').ravel()
+    test_age = 10.**log_zams_mini[np.newaxis,:] + t_values[:,np.newaxis]
+    
+    # keep only the (age, mass) pairs within the age range; np.nonzero walks the grid age by age, 
+    # and by increasing mass index within each age, i.e. in the order of the former per-star loop
+    age_index, mass_index = np.nonzero(test_age < 10.**log_tacheb_mini[np.newaxis,:])
+    columns = _isochrone_rows(age_index, mass_index, t_values, log_Mini, log_zams_mini, log_tacheb_mini, knn_model, ffNN, batch_size)
+    
+    with stage_stats.stage('dataframes', len(age_index)):
+        # integral data frame with the observables, zams masses and ages
+        all_columns_df = pd.DataFrame(columns)
         
-            # 2) ... the time past the star's ZAMS age
-            test_age = 10.**log_zams+t 
-       
-            # 3) ... the observables at that test age, if the test age is within the age range
-            if test_age < 10.**log_tacheb: 
+        # logL, logTeff and logg values over all ZAMS masses (single isochrone), stored in dict
+        iso_dict = {}
+        for k, t in enumerate(iso_values):
+            rows = age_index == k
+            iso_dict[t] = pd.DataFrame({"logL": columns["logL"][rows], "logT": columns["logTeff"][rows], "logg": columns["logg"][rows]})
+    
+    return iso_dict, all_columns_df
+
+# streaming version of isochrone_computation: yields the rows of all_columns_df (in the same order, and with the same 
+# row index) as data frames of chunk_size rows (the last one possibly shorter), skipping the knn & ffnn predictions of 
+# the first start_chunk chunks; the (isochrone values x ZAMS masses) grid is walked in blocks of about chunk_size 
+# entries, so that memory stays flat however many isochrones are computed
+def isochrone_chunks(log_Mini, iso_values, gpr_modelTA, gpr_modelTE, knn_model, ffNN, chunk_size = 65536, start_chunk = 0, batch_size = 65536):
+    import pandas as pd
+    
+    log_Mini = np.asarray(log_Mini, dtype = 'float64').ravel()
+    with stage_stats.stage('age_models', len(log_Mini)):
+        log_zams_mini = gpr_modelTA.predict(log_Mini.reshape(-1,1))
+        log_tacheb_mini = gpr_modelTE.predict(log_Mini.reshape(-1,1))
+    zams_age, tacheb_age = 10.**log_zams_mini, 10.**log_tacheb_mini
+    t_values = np.asarray(iso_values, dtype = 'float64').ravel()
+    
+    ages_per_block = max(1, chunk_size // max(len(log_Mini), 1))
+    pending_age, pending_mass, n_pending = [], [], 0
+    chunk_index = 0
+    for first in range(0, len(t_values), ages_per_block):
+        test_age = zams_age[np.newaxis,:] + t_values[first:first+ages_per_block,np.newaxis]
+        age_index, mass_index = np.nonzero(test_age < tacheb_age[np.newaxis,:])
+        pending_age.append(age_index + first)
+        pending_mass.append(mass_index)
+        n_pending += len(age_index)
+        last_block = first + ages_per_block >= len(t_values)
+        if n_pending < chunk_size and not last_block:
+            continue
         
-                # scaled age variable calculation
-                t_scaled = t_calc(log_zams, log_tacheb, np.log10( test_age ))
-            
-                # knn prediction of the timescale-adapted evolutionary coordinate 
-                s_pred = knn_model.predict(np.array([t_scaled, log_M_val]).reshape(1,-1))
-            
-                # ffnn prediction of observables
-                output_nn = ffNN.predict(np.array([float(s_pred), log_M_val]).reshape(1,-1))
-            
-                # store logL, logTeff & logg predictions in lists
-                L_vals.append(output_nn[0,0]), T_vals.append(output_nn[0,1]), g_vals.append(output_nn[0,2])
-                
-                # store data frame containing all pertinent variables
-                all_data_lists.append([output_nn[0,0], output_nn[0,1], output_nn[0,2], log_M_val, np.log10(t), np.log10(test_age), t_scaled])
-    
-        # extracting logL, logTeff and logg values over all ZAMS masses (single isochrone)
-        iso_vals.logL, iso_vals.logT, iso_vals.logg = L_vals, T_vals, g_vals
-        # ... and storing them in dict
-        iso_dict[t] = iso_vals
-    # integral data frame with the observables, zams masses and ages
-    all_columns_df = pd.DataFrame(all_data_lists, columns = ["logL", "logTeff", "logg", "logMini", "isochrone", "test_age", "t_scaled"])
-    
-    return iso_dict, all_columns_df
\ No newline at end of file
+        # full chunks of the pending (age, mass) pairs; the remainder is carried over to the next block
+        age_index, mass_index = np.concatenate(pending_age), np.concatenate(pending_mass)
+        n_rows = n_pending if last_block else (n_pending // chunk_size)*chunk_size
+        for start in range(0, n_rows, chunk_size):
+            stop = min(start + chunk_size, n_rows)
+            if chunk_index >= start_chunk:
+                columns = _isochrone_rows(age_index[start:stop], mass_index[start:stop], t_values, log_Mini, 
+                                          log_zams_mini, log_tacheb_mini, knn_model, ffNN, batch_size)
+                with stage_stats.stage('dataframes', stop - start):
+                    first_row = chunk_index*chunk_size
+                    chunk = pd.DataFrame(columns, index = pd.RangeIndex(first_row, first_row + stop - start))
+                yield chunk
+            chunk_index += 1
+        pending_age, pending_mass, n_pending = [age_index[n_rows:]], [mass_index[n_rows:]], n_pending - n_rows
+
+# streaming version of HR_and_Kiel_tracks: yields data frames with the columns logL, logTeff, logg, logMini and s, 
+# for chunks of (about) chunk_size rows of whole tracks, skipping the first start_chunk chunks
+def HR_and_Kiel_track_chunks(M_ZAMS, s_sampling, ffNN, chunk_size = 65536, start_chunk = 0, batch_size = 65536):
+    import pandas as pd
+    
+    M_ZAMS = np.asarray(M_ZAMS, dtype = 'float64').ravel()
+    s_grid = np.broadcast_to(np.asarray(s_sampling, dtype = 'float64'), (len(M_ZAMS), np.shape(s_sampling)[-1]))
+    tracks_per_chunk = max(1, chunk_size // max(s_grid.shape[1], 1))
+    for chunk_index, first in enumerate(range(0, len(M_ZAMS), tracks_per_chunk)):
+        if chunk_index < start_chunk:
+            continue
+        tracks = HR_and_Kiel_tracks(M_ZAMS[first:first+tracks_per_chunk], s_grid[first:first+tracks_per_chunk], ffNN, batch_size)
+        first_row = first*s_grid.shape[1]
+        with stage_stats.stage('dataframes', tracks.shape[0]*tracks.shape[1]):
+            chunk = pd.DataFrame({"logL": tracks[:,:,0].ravel(), "logTeff": tracks[:,:,1].ravel(), "logg": tracks[:,:,2].ravel(),
+                                  "logMini": np.repeat(np.log10(M_ZAMS[first:first+tracks_per_chunk]), s_grid.shape[1]),
+                                  "s": s_grid[first:first+tracks_per_chunk].ravel()},
+                                 index = pd.RangeIndex(first_row, first_row + tracks.shape[0]*tracks.shape[1]))
+        yield chunk
+
+# isochrone_chunks written to a Parquet directory or an HDF5 file (see chunked_output.py); an interrupted run 
+# with the same ZAMS masses, isochrone values and chunk_size resumes from the last completed chunk
+def write_isochrones(path, log_Mini, iso_values, gpr_modelTA, gpr_modelTE, knn_model, ffNN, chunk_size = 65536, 
+                     format = None, resume = True, batch_size = 65536):
+    from chunked_output import write_chunks, array_digest
+    parameters = {'kind': 'isochrones', 'chunk_size': chunk_size, 'inputs': array_digest(log_Mini, iso_values)}
+    return write_chunks(path, lambda start_chunk: isochrone_chunks(log_Mini, iso_values, gpr_modelTA, gpr_modelTE, knn_model, ffNN, 
+                                                                   chunk_size, start_chunk, batch_size), 
+                        parameters, format, resume)
+
+# HR_and_Kiel_track_chunks written to a Parquet directory or an HDF5 file (see chunked_output.py), resumable as write_isochrones
+def write_tracks(path, M_ZAMS, s_sampling, ffNN, chunk_size = 65536, format = None, resume = True, batch_size = 65536):
+    from chunked_output import write_chunks, array_digest
+    parameters = {'kind': 'tracks', 'chunk_size': chunk_size, 'inputs': array_digest(M_ZAMS, s_sampling)}
+    return write_chunks(path, lambda start_chunk: HR_and_Kiel_track_chunks(M_ZAMS, s_sampling, ffNN, chunk_size, start_chunk, batch_size), 
+                        parameters, format, resume)
+
+####################################################################################################
+############################################ Model loading #########################################
+####################################################################################################
+
+class Emulator:
+
+    """
+
+    Loads the fitted models from the models directory on first use, and evaluates the emulator routines with them.
+
+    Args:
+        models_path: directory containing gpr_modelTA.pkl, gpr_modelTE.pkl, knn_model.pkl and ffNN (or ffNN_weights.npz).
+        ffNN_backend: 'numpy' (NumpyFFNN on ffNN_weights.npz, without importing TensorFlow), 'keras' (the ffNN
+                      SavedModel), or 'auto' (numpy if ffNN_weights.npz exists, keras otherwise).
+        age_backend: 'table' (AgeLookupTable on age_table_TA.npz & age_table_TE.npz, see emulator_backends.py), 'gpr'
+                     (the GPR models), or 'auto' (table if both lookup tables exist, gpr otherwise).
+        knn_backend: 'kdtree' (KDTreeKNN on knn_data.npz, see emulator_backends.py), 'sklearn' (the pickled KNN model),
+                     or 'auto' (kdtree if knn_data.npz exists, sklearn otherwise).
+
+    Usage:
+        >> emulator = Emulator('models')
+        >> logL_logTeff_logg = emulator.observables(1e7, np.log10(10.))
+        >> emulator.load_times
+
+    Attributes:
+        gpr_modelTA     GPR model of the (log) stellar age at ZAMS.
+        gpr_modelTE     GPR model of the (log) stellar age at TACHeB.
+        age_modelTA     Model of the (log) stellar age at ZAMS used by the emulator routines (lookup table or GPR).
+        age_modelTE     Model of the (log) stellar age at TACHeB used by the emulator routines (lookup table or GPR).
+        knn_model       KNN model of the evolutionary coordinate s (KD-tree backend or pickled model).
+        ffNN            ffNN model of logL, logTeff and logg.
+        load_times      Dictionary containing the load time in seconds of each model loaded so far.
+
+    """
+
+    def __init__(self, models_path = 'models', ffNN_backend = 'auto', age_backend = 'auto', knn_backend = 'auto'):
+        if ffNN_backend not in ['auto', 'numpy', 'keras']:
+            raise ValueError("ffNN_backend must be one of 'auto', 'numpy', 'keras'")
+        if age_backend not in ['auto', 'table', 'gpr']:
+            raise ValueError("age_backend must be one of 'auto', 'table', 'gpr'")
+        if knn_backend not in ['auto', 'kdtree', 'sklearn']:
+            raise ValueError("knn_backend must be one of 'auto', 'kdtree', 'sklearn'")
+        if ffNN_backend == 'auto':
+            ffNN_backend = 'numpy' if os.path.exists(os.path.join(models_path, 'ffNN_weights.npz')) else 'keras'
+        if age_backend == 'auto':
+            tables_exist = all(os.path.exists(os.path.join(models_path, 'age_table_' + name + '.npz')) for name in ['TA', 'TE'])
+            age_backend = 'table' if tables_exist else 'gpr'
+        if knn_backend == 'auto':
+            knn_backend = 'kdtree' if os.path.exists(os.path.join(models_path, 'knn_data.npz')) else 'sklearn'
+        self.models_path = models_path
+        self.ffNN_backend = ffNN_backend
+        self.age_backend = age_backend
+        self.knn_backend = knn_backend
+        self.load_times = {}
+        self._models = {}
+
+    def _load(self, name, loader):
+        if name not in self._models:
+            StartTime = time.perf_counter()
+            self._models[name] = loader()
+            self.load_times[name] = time.perf_counter() - StartTime
+        return self._models[name]
+
+    def _load_pickle(self, filename):
+        with open(os.path.join(self.models_path, filename), 'rb') as f:
+            return pickle.load(f)
+
+    def _load_ffNN(self):
+        if self.ffNN_backend == 'numpy':
+            from emulator_backends import NumpyFFNN
+            return NumpyFFNN(os.path.join(self.models_path, 'ffNN_weights.npz'))
+        from tensorflow import keras
+        return keras.models.load_model(os.path.join(self.models_path, 'ffNN'))
+
+    @property
+    def gpr_modelTA(self):
+        return self._load('gpr_modelTA', lambda: self._load_pickle('gpr_modelTA.pkl'))
+
+    @property
+    def gpr_modelTE(self):
+        return self._load('gpr_modelTE', lambda: self._load_pickle('gpr_modelTE.pkl'))
+
+    # lookup table of an age model; the GPR is only loaded for log M_ZAMS outside of the tabulated range
+    def _load_age_table(self, name):
+        from emulator_backends import AgeLookupTable
+        return AgeLookupTable(os.path.join(self.models_path, 'age_table_' + name + '.npz'), fallback = lambda: getattr(self, 'gpr_model' + name))
+
+    @property
+    def age_modelTA(self):
+        if self.age_backend == 'gpr':
+            return self.gpr_modelTA
+        return self._load('age_tableTA', lambda: self._load_age_table('TA'))
+
+    @property
+    def age_modelTE(self):
+        if self.age_backend == 'gpr':
+            return self.gpr_modelTE
+        return self._load('age_tableTE', lambda: self._load_age_table('TE'))
+
+    def _load_knn(self):
+        if self.knn_backend == 'kdtree':
+            from emulator_backends import KDTreeKNN
+            return KDTreeKNN(os.path.join(self.models_path, 'knn_data.npz'))
+        return self._load_pickle('knn_model.pkl')
+
+    @property
+    def knn_model(self):
+        return self._load('knn_model', self._load_knn)
+
+    @property
+    def ffNN(self):
+        return self._load('ffNN', self._load_ffNN)
+
+    # loads all models used by the emulator routines at once (e.g. before forking worker processes) and returns the load times
+    def load_all(self):
+        self.age_modelTA, self.age_modelTE, self.knn_model, self.ffNN
+        return self.load_times
+
+    def observables(self, test_age, log_M_ZAMS):
+        return observables_fixed_tau_MZAMS(test_age, log_M_ZAMS, self.age_modelTA, self.age_modelTE, self.knn_model, self.ffNN)
+
+    def population(self, test_ages, log_M_ZAMS, chunk_size = 32768):
+        return observables_population(test_ages, log_M_ZAMS, self.age_modelTA, self.age_modelTE, self.knn_model, self.ffNN, chunk_size)
+
+    def synthetic_population(self, n_stars, age_min, age_max, SFR = None, M_min = 0.7, M_max = 300., alpha = 2.35, rng = None, chunk_size = 32768):
+        return synthetic_population(n_stars, self.age_modelTA, self.age_modelTE, self.knn_model, self.ffNN, age_min, age_max, SFR, 
+                                    M_min, M_max, alpha, rng, chunk_size)
+
+    def tracks(self, M_ZAMS, s_sampling, batch_size = 65536):
+        return HR_and_Kiel_tracks(M_ZAMS, s_sampling, self.ffNN, batch_size)
+
+    def isochrones(self, log_Mini, iso_values, batch_size = 65536):
+        return isochrone_computation(log_Mini, iso_values, self.age_modelTA, self.age_modelTE, self.knn_model, self.ffNN, batch_size)
+
+    def isochrone_chunks(self, log_Mini, iso_values, chunk_size = 65536, start_chunk = 0, batch_size = 65536):
+        return isochrone_chunks(log_Mini, iso_values, self.age_modelTA, self.age_modelTE, self.knn_model, self.ffNN, chunk_size, start_chunk, batch_size)
+
+    def write_isochrones(self, path, log_Mini, iso_values, chunk_size = 65536, format = None, resume = True, batch_size = 65536):
+        return write_isochrones(path, log_Mini, iso_values, self.age_modelTA, self.age_modelTE, self.knn_model, self.ffNN, 
+                                chunk_size, format, resume, batch_size)
+
+    def track_chunks(self, M_ZAMS, s_sampling, chunk_size = 65536, start_chunk = 0, batch_size = 65536):
+        return HR_and_Kiel_track_chunks(M_ZAMS, s_sampling, self.ffNN, chunk_size, start_chunk, batch_size)
+
+    def write_tracks(self, path, M_ZAMS, s_sampling, chunk_size = 65536, format = None, resume = True, batch_size = 65536):
+        return write_tracks(path, M_ZAMS, s_sampling, self.ffNN, chunk_size, format, resume, batch_size)
+
+    def adaptive_tracks(self, M_ZAMS, **kwargs):
+        return HR_and_Kiel_tracks_adaptive(M_ZAMS, self.ffNN, **kwargs)